@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+# Times complete installations into clusters of simulated slaves, using the installer's 'local' transport, and reports
+# how long each took, how many remote operations it made, and how many bytes it moved. Any arguments that this script
+# doesn't know are passed on to the installer. With --topology, it instead measures how long planning the Weave router
+# peers takes, and how big that makes the router service files, with and without a full mesh. With --mock-master, a
+# stand-in for the Mesos master's API runs tasks on the simulated slaves, for the 'drain' restart strategy to move.
+# The Weave script installed is a simulation of the mesh the routers would form, so that how long that takes (with
+# whatever --weave-router-* options are passed on) is measured too.
+
+import sys
+from subprocess import call
+import os
+import json
+import time
+import tempfile
+import shutil
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import install
+
+
+# The executor environment file every simulated slave starts with
+EXECUTOR_ENV_FILE = "/opt/mesosphere/etc/mesos-executor-environment.json"
+
+# Installed on the simulated slaves in place of the Weave script. 'weave status' describes the mesh as it would be,
+# given which routers have been started (and when), and the peers each was given: a connection is established shortly
+# after both of its ends are up, news of a peer takes a while to travel each hop, and IPAM is ready once a majority of
+# the initial peer count is known.
+SIMULATED_WEAVE = r'''#!python
+import heapq, os, re, sys, time
+CONNECT_DELAY = 0.3
+GOSSIP_DELAY = 0.2
+if sys.argv[1:2] != ["status"]:
+    sys.exit(0)
+host_root = os.environ["WIM_HOST_ROOT"]
+cluster_root = os.path.dirname(host_root)
+me = os.path.basename(host_root)
+
+def read(host, path):
+    try:
+        with open(os.path.join(cluster_root, host, path)) as source:
+            return source.read()
+    except IOError:
+        return ""
+
+def started(host):
+    path = os.path.join(cluster_root, host, "run/wim-units/weave-router.service")
+    return os.path.getmtime(path) if read(host, "run/wim-units/weave-router.service").strip() == "active" else None
+
+def peers(host):
+    match = re.search(r'WEAVE_ROUTER_PEERS="([^"]*)"', read(host, "etc/weave." + host + ".env"))
+    return match.group(1).split() if match else []
+
+hosts = [host for host in os.listdir(cluster_root) if not host.startswith(".")]
+starts = dict((host, started(host)) for host in hosts)
+if starts.get(me) is None:
+    print "weave container is not present. Have you launched it?"
+    sys.exit(1)
+links = dict((host, set()) for host in hosts)
+for host in hosts:
+    for peer in peers(host):
+        if peer in links and peer != host:
+            links[host].add(peer)
+            links[peer].add(host)
+
+def established(a, b):
+    if starts[a] is None or starts[b] is None:
+        return None
+    return max(starts[a], starts[b]) + CONNECT_DELAY
+
+# When each peer becomes known here, by gossip over established connections
+known = {me: starts[me]}
+queue = [(starts[me], me)]
+while len(queue) != 0:
+    at, host = heapq.heappop(queue)
+    if at > known.get(host, at):
+        continue
+    for peer in links[host]:
+        since = established(host, peer)
+        if since is None:
+            continue
+        arrival = max(at, since) + GOSSIP_DELAY
+        if arrival < known.get(peer, float("inf")):
+            known[peer] = arrival
+            heapq.heappush(queue, (arrival, peer))
+
+now = time.time()
+peer_count = len([host for host in known if known[host] <= now])
+connections = [peer for peer in links[me] if starts[peer] is not None]
+established_count = len([peer for peer in connections if established(me, peer) <= now])
+match = re.search(r'--init-peer-count[ =](\d+)', read(me, "etc/systemd/system/weave-router.service"))
+init_peer_count = int(match.group(1)) if match else len(peers(me)) + 1
+print "        Service: router"
+print "        Targets: " + str(len(peers(me)))
+print "    Connections: {0} ({1} established)".format(len(connections), established_count)
+print "          Peers: " + str(peer_count)
+print ""
+print "        Service: ipam"
+print "         Status: " + ("ready" if peer_count >= init_peer_count / 2 + 1 else "awaiting consensus")
+'''
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the installer against clusters of simulated slaves.")
+    parser.add_argument(
+        "--sizes",
+        dest="sizes",
+        default="10,100,1000",
+        help="Comma-separated numbers of slaves to install into, one run each. (default: '%(default)s')"
+    )
+    parser.add_argument(
+        "--parallelism",
+        dest="parallelism",
+        type=int,
+        default=10,
+        help="How many slaves the installer works on at once, and restarts at once. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--latency",
+        dest="latency",
+        type=float,
+        default=0.0,
+        help="Seconds added to every remote operation, to simulate the round trip to a real slave. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        dest="failure_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of remote operations that fail. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        help="Directory for the simulated slaves, reports and installer output, which is kept. (default: a temporary directory, removed afterwards)"
+    )
+    parser.add_argument(
+        "--topology",
+        dest="topology",
+        action="store_true",
+        help="Benchmark planning the Weave router peers instead of installing."
+    )
+    parser.add_argument(
+        "--mock-master",
+        dest="mock_master",
+        action="store_true",
+        help="Run a stand-in for the Mesos master's API, with tasks on every slave, and point the installer at it."
+    )
+    parser.add_argument(
+        "--mock-master-tasks",
+        dest="mock_master_tasks",
+        type=int,
+        default=2,
+        help="With --mock-master, how many tasks run on each slave. (default: %(default)s)"
+    )
+    args, installer_args = parser.parse_known_args()
+
+    if args.topology:
+        print_topology_results([benchmark_topology(int(size)) for size in args.sizes.split(",")])
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="wim-benchmark-")
+    try:
+        results = []
+        for size in [int(size) for size in args.sizes.split(",")]:
+            results.append(run(size, args, installer_args, work_dir))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+    if any(result['exit_code'] != 0 for result in results) and args.failure_rate == 0:
+        sys.exit(1)
+
+
+def run(size, args, installer_args, work_dir):
+
+    # A fresh cluster of simulated slaves, with nothing installed yet
+    run_dir = work_dir + "/" + str(size)
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    cluster_dir = run_dir + "/cluster"
+    slaves = ["slave" + str(index) for index in range(size)]
+    for slave in slaves:
+        seed_slave(cluster_dir + "/" + slave)
+
+    # With tasks on them, if we're to mock the master
+    master = None
+    if args.mock_master:
+        master = MockMesosMaster(slaves, args.mock_master_tasks)
+        installer_args = ["--mesos-master-url", master.url] + installer_args
+
+    # Install into all of them, from a copy of this directory with the simulated Weave script
+    source_dir = prepare_source(run_dir)
+    report_file = run_dir + "/report.jsonl"
+    command = [
+        sys.executable, source_dir + "/install.py",
+        "--transport", "local",
+        "--local-transport-root", cluster_dir,
+        "--local-transport-latency", str(args.latency),
+        "--local-transport-failure-rate", str(args.failure_rate),
+        "--local-transport-random-seed", "0",
+        "--mesos-flavor", "dcos",
+        "--mesos-private-slaves", ",".join(slaves),
+        "--mesos-slave-executor-env-file", EXECUTOR_ENV_FILE,
+        "--parallelism", str(args.parallelism),
+        "--mesos-max-unavailable", str(args.parallelism),
+        "--report-file", report_file,
+        "--local-tmp-dir", run_dir,
+        "--skip-warnings", "yes"
+    ] + installer_args
+    print "Installing into " + str(size) + " simulated slaves"
+    start = time.time()
+    with open(run_dir + "/output.txt", "w") as output:
+        exit_code = call(command, stdout=output, stderr=output, cwd=source_dir)
+    elapsed = time.time() - start
+    if master is not None:
+        master.stop()
+        print "Mock master: {0} tasks moved off draining slaves, {1} killed by slaves going down, {2} maintenance windows left".format(
+            master.moved, master.killed, len(master.schedule['windows'])
+        )
+
+    # Only whole remote operations count; script steps are part of them
+    operations = []
+    if os.path.exists(report_file):
+        with open(report_file) as source:
+            operations = [record for record in map(json.loads, source) if not 'script_step' in record]
+
+    # And how long the Weave mesh took to form
+    mesh = {}
+    mesh_report_file = run_dir + "/wim-mesh.jsonl"
+    if os.path.exists(mesh_report_file):
+        with open(mesh_report_file) as source:
+            mesh = json.loads(source.readlines()[-1])['summary']
+
+    return {
+        'size': size,
+        'mesh': mesh,
+        'exit_code': exit_code,
+        'elapsed': elapsed,
+        'operations': len(operations),
+        'failed_operations': len([record for record in operations if record['exit_code'] != 0]),
+        'bytes_sent': sum(record['bytes_sent'] for record in operations),
+        'bytes_received': sum(record['bytes_received'] for record in operations)
+    }
+
+
+def prepare_source(run_dir):
+
+    # Everything the installer reads from its own directory, but with the Weave script simulated
+    source_dir = run_dir + "/source"
+    os.makedirs(source_dir)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in os.listdir(here):
+        if os.path.isfile(here + "/" + name) and name != "weave" and not name.endswith(".pyc"):
+            os.symlink(here + "/" + name, source_dir + "/" + name)
+    with open(source_dir + "/weave", "w") as sink:
+        sink.write(SIMULATED_WEAVE.replace("#!python", "#!" + sys.executable, 1))
+    os.chmod(source_dir + "/weave", 0755)
+    return source_dir
+
+
+def seed_slave(slave_dir):
+    env_dir = slave_dir + os.path.dirname(EXECUTOR_ENV_FILE)
+    os.makedirs(env_dir)
+    with open(slave_dir + EXECUTOR_ENV_FILE, "w") as sink:
+        sink.write("{}")
+
+
+class MockMesosMaster:
+
+    # Seconds after its maintenance starts that a slave's tasks are moved elsewhere, as a framework would
+    DRAIN_DELAY = 0.5
+
+    def __init__(self, slaves, tasks_per_slave):
+
+        # Every slave with its share of tasks, nothing scheduled for maintenance, and nothing down
+        self.agents = []
+        for index, slave in enumerate(slaves):
+            self.agents.append({'id': "agent-" + str(index), 'hostname': slave, 'pid': "slave(1)@10.0." + str(index / 256) + "." + str(index % 256) + ":5051"})
+        self.tasks = []
+        for agent in self.agents:
+            for _ in range(tasks_per_slave):
+                self.add_task(agent)
+        self.schedule = {'windows': []}
+        self.down = []
+        self.moved = 0
+        self.killed = 0
+        self.lock = threading.Lock()
+
+        # Serve the API from another thread
+        master = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(master.get(self.path))
+            def do_POST(self):
+                self.respond(master.post(self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+            def respond(self, (status, body)):
+                content = json.dumps(body) if body is not None else ""
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+    def stop(self):
+        self.server.shutdown()
+
+
+    def add_task(self, agent):
+        self.tasks.append({'id': "task-" + str(len(self.tasks)), 'slave_id': agent['id'], 'state': "TASK_RUNNING"})
+
+
+    def machine(self, agent):
+        return {'hostname': agent['hostname'], 'ip': agent['pid'].rpartition("@")[2].partition(":")[0]}
+
+
+    def get(self, path):
+        with self.lock:
+            if path == "/slaves":
+                return 200, {'slaves': self.agents}
+            if path.startswith("/tasks"):
+                self.drain()
+                return 200, {'tasks': self.tasks}
+            if path == "/maintenance/schedule":
+                return 200, self.schedule
+        return 404, None
+
+
+    def post(self, path, data):
+        with self.lock:
+            if path == "/maintenance/schedule":
+                # As the real master does, refuse to drop a machine that is down from the schedule
+                scheduled = [machine for window in data['windows'] for machine in window['machine_ids']]
+                if any(not machine in scheduled for machine in self.down):
+                    return 400, None
+                self.schedule = data
+                return 200, None
+            if path == "/machine/down":
+                # Only machines scheduled for maintenance can go down, and whatever still runs on them is killed
+                scheduled = [machine for window in self.schedule['windows'] for machine in window['machine_ids']]
+                if any(not machine in scheduled for machine in data):
+                    return 400, None
+                self.down += data
+                for agent in self.agents:
+                    if self.machine(agent) in data:
+                        self.killed += self.move_tasks(agent)
+                return 200, None
+            if path == "/machine/up":
+                self.down = [machine for machine in self.down if not machine in data]
+                return 200, None
+        return 404, None
+
+
+    def drain(self):
+
+        # Frameworks move the tasks off a machine soon after its maintenance starts
+        now = time.time()
+        for window in self.schedule['windows']:
+            if now - window['unavailability']['start']['nanoseconds'] / 1e9 < MockMesosMaster.DRAIN_DELAY:
+                continue
+            for agent in self.agents:
+                if self.machine(agent) in window['machine_ids']:
+                    self.moved += self.move_tasks(agent)
+
+
+    def move_tasks(self, agent):
+
+        # Move the agent's tasks to agents that aren't scheduled for maintenance, as the scheduler would
+        scheduled = [machine for window in self.schedule['windows'] for machine in window['machine_ids']]
+        targets = [other for other in self.agents if not self.machine(other) in scheduled]
+        tasks = [task for task in self.tasks if task['slave_id'] == agent['id']]
+        for index, task in enumerate(tasks):
+            task['slave_id'] = targets[index % len(targets)]['id'] if len(targets) != 0 else None
+        return len(tasks)
+
+
+def print_results(results):
+
+    def mesh_seconds(mesh, key):
+        stats = mesh.get('seconds_to_mesh')
+        return "-" if stats is None else "{0:.1f}".format(stats[key])
+
+    print "=================================================================="
+    print "  {0:>7} {1:>9} {2:>9} {3:>7} {4:>7} {5:>12} {6:>12} {7:>5} {8:>9} {9:>8} {10:>8}".format(
+        "slaves", "seconds", "ops", "ops/sl", "failed", "bytes sent", "bytes recvd", "exit", "converged", "mesh p50", "mesh max"
+    )
+    for result in results:
+        mesh = result['mesh']
+        print "  {0:>7} {1:>9.2f} {2:>9} {3:>7.1f} {4:>7} {5:>12} {6:>12} {7:>5} {8:>9} {9:>8} {10:>8}".format(
+            result['size'],
+            result['elapsed'],
+            result['operations'],
+            float(result['operations']) / result['size'],
+            result['failed_operations'],
+            result['bytes_sent'],
+            result['bytes_received'],
+            result['exit_code'],
+            "-" if len(mesh) == 0 else str(mesh['converged']) + "/" + str(mesh['slaves']),
+            mesh_seconds(mesh, 'p50'),
+            mesh_seconds(mesh, 'max')
+        )
+
+
+def benchmark_topology(size):
+
+    # Plan the peers the default way, and as a full mesh, then render the router service file (the same on every
+    # slave, with the peers and initial peer count coming from its environment) and every slave's environment file
+    slaves = ["slave" + str(index) + ".private.mesos.example.com" for index in range(size)]
+    template = install.load_template("./weave-router.service")
+    results = {'size': size}
+    for name, seed_count in [('full', size), ('bounded', 3)]:
+        start = time.time()
+        peers = install.plan_peers(slaves, seed_count, 2)
+        init_peer_count = install.plan_init_peer_count(slaves, peers, None)
+        elapsed = time.time() - start
+        substitutions = [{'pattern': placeholder, 'replacement': ""} for placeholder in template.placeholders if not placeholder in ["{{PEERS}}", "{{INIT_PEER_COUNT}}"]]
+        substitutions.append({'pattern': "{{PEERS}}", 'replacement': "$WEAVE_ROUTER_PEERS"})
+        substitutions.append({'pattern': "{{INIT_PEER_COUNT}}", 'replacement': "" if init_peer_count is None else "--init-peer-count $" + install.INIT_PEER_COUNT_VARIABLE})
+        unit_size = len(template.render(substitutions))
+        sizes = [len(install.router_environment(peers[slave], init_peer_count=init_peer_count)) for slave in slaves]
+        results[name] = {
+            'elapsed': elapsed,
+            'unit_size': unit_size,
+            'max_size': max(sizes),
+            'total_size': unit_size * size + sum(sizes),
+            'connections': sum(len(peers[slave]) for slave in slaves)
+        }
+    return results
+
+
+def print_topology_results(results):
+
+    print "=================================================================="
+    print "  {0:>7} {1:>8} {2:>9} {3:>10} {4:>9} {5:>13} {6:>11}".format("slaves", "topology", "plan ms", "unit bytes", "env bytes", "all files", "peer links")
+    for result in results:
+        for name in ['full', 'bounded']:
+            topology = result[name]
+            print "  {0:>7} {1:>8} {2:>9.1f} {3:>10} {4:>9} {5:>13} {6:>11}".format(
+                result['size'], name, topology['elapsed'] * 1000, topology['unit_size'], topology['max_size'], topology['total_size'], topology['connections']
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,29 @@
 
 # System
 import sys
-from subprocess import call
-import string
+from subprocess import Popen, PIPE, STDOUT
 import os
 import pwd
-import grp
 import json
 from distutils.util import strtobool
 import re
+import threading
+import Queue
+import time
+import tempfile
+import copy
+import shutil
+import pipes
+import tarfile
+import io
+import hashlib
+import binascii
+import random
+import signal
+import urllib2
+import ConfigParser
+import collections
+import stat
 
 
 # Third Party
@@ -20,11 +35,49 @@ class Installer:
 
     FLAVOR_VANILLA = "vanilla"
     FLAVOR_DCOS = "dcos"
+    FLAVOR_AUTO = "auto"
+
+    TRANSPORT_SSH = "ssh"
+    TRANSPORT_LOCAL = "local"
+
+    DISTRIBUTION_DIRECT = "direct"
+    DISTRIBUTION_TREE = "tree"
+
+    RESTART_PLAIN = "restart"
+    RESTART_RECOVER = "recover"
+    RESTART_DRAIN = "drain"
+
+    SCOPE_MODE_STANDALONE = "standalone"
+    SCOPE_MODE_CENTRAL = "central"
+
+    SCOPE_ROLE_APP = "app"
+    SCOPE_ROLE_PROBE = "probe"
+
+    # Seconds between checks on whether restarted services are active
+    HEALTH_CHECK_INTERVAL = 2
+
+    # Seconds between checks on whether a Weave router sees the whole mesh
+    MESH_CHECK_INTERVAL = 1
+
+    # Seconds between checks on whether a draining Mesos slave still has tasks, and the most tasks asked about at once
+    DRAIN_CHECK_INTERVAL = 2
+    MASTER_TASKS_LIMIT = 100000
+
+    # Steps that mustn't be run twice, so aren't tried again when the slave can't be reached part of the way through
+    UNRETRIED_STEPS = ["restart-slave"]
+
+    # The longest wait before trying a remote operation again, however many times it failed
+    RETRY_BACKOFF_MAX = 30
 
     def main(self):
 
-        # Handle arguments
+        # Handle arguments. A plan is all that goes to the console when planning.
         self.parse_arguments()
+        if self.args.clusters_file is not None:
+            self.install_clusters()
+            return
+        if self.args.dry_run:
+            set_logging(False)
         self.default_arguments()
         self.process_arguments()
 
@@ -36,22 +89,59 @@ class Installer:
         if not os.path.exists("weave-scope"):
             raise ValueError("Weave Scope executable has not been downloaded yet. Use 'make setup' to get it.")
 
-        # Do the deed
-        self.install()
-
-
-    def parse_arguments(self):
+        # Just plan the deed, if that's all we were asked to do. The transport is only asked how it would relay, but is
+        # still closed, so that it leaves nothing behind.
+        self.transport = self.create_transport()
+        if self.args.dry_run:
+            try:
+                self.plan_install()
+            finally:
+                self.transport.close()
+            return
+
+        # Do the deed, reusing one connection per slave for the whole run, and journaling each step completed on each
+        # slave so that a failed run can be resumed (a probe completes no steps, so it leaves the journal alone)
+        self.journal = Journal(None if self.args.probe_only else self.args.journal_file, resume=self.args.resume)
+        if self.args.resume:
+            print "Resuming from journal: " + self.args.journal_file + " (" + str(len(self.journal.entries)) + " completed steps)"
+        console.start(self.args.log_dir, self.args.console, append=self.args.resume)
+        try:
+            if self.args.probe_only:
+                results = self.probe_only()
+            else:
+                results = self.install()
+        finally:
+            self.transport.close()
+            self.journal.close()
+            self.facts_cache.save()
+            console.stop()
+        if not self.args.probe_only:
+            self.print_summary(results)
+        print "Full output of each slave written to: " + self.args.log_dir
+
+        # Report where the time went
+        self.report.write(self.args.report_file)
+        self.report.print_summary()
+        print "Report of every remote operation written to: " + self.args.report_file
+
+        # Report a failure to the shell if any slave could not be installed, or the Weave mesh didn't form
+        if any(result.error is not None for result in results) or not self.mesh_converged:
+            sys.exit(1)
+
+
+    def parse_arguments(self, args=None):
 
         # Create an argument parser
         self.parser = configargparse.ArgumentParser(description='Install Weave to a Mesos cluster')
 
         # Add arguments to the parser
         self.add_common_arguments()
+        self.add_transport_arguments()
         self.add_mesos_arguments()
         self.add_weave_arguments()
 
-        # Parse arguments out of the command line
-        self.args = self.parser.parse_args()
+        # Parse arguments out of the command line (or the given list)
+        self.args = self.parser.parse_args(args)
 
 
     def add_common_arguments(self):
@@ -83,6 +173,222 @@ class Installer:
             help="Skip warnings about proceeding with installation at various points. (default: '%(default)s')"
         )
 
+        # Report file
+        self.parser.add_argument(
+            "--report-file",
+            dest="report_file",
+            env_var='WIM_REPORT_FILE',
+            help="Path for a JSON Lines report with the timing of every remote operation. (default: <local_tmp_dir>/wim-report.jsonl)"
+        )
+
+        # Journal
+        self.parser.add_argument(
+            "--journal-file",
+            dest="journal_file",
+            env_var='WIM_JOURNAL_FILE',
+            help="File to record each step completed on each slave in, as one JSON object per line. (default: <local_tmp_dir>/wim-journal.jsonl)"
+        )
+        self.parser.add_argument(
+            "--resume",
+            dest="resume",
+            env_var='WIM_RESUME',
+            action='store_true',
+            help="Continue the run recorded in the journal file, skipping each step it completed on each slave, as long as that step would do the same again."
+        )
+
+        # Slave facts
+        self.parser.add_argument(
+            "--facts-ttl",
+            dest="facts_ttl",
+            env_var='WIM_FACTS_TTL',
+            type=int,
+            default=60,
+            help="How many seconds what was found out about each slave before installing is remembered for, so that runs close together (such as a plan and then the installation) don't each probe the slaves. Slaves the installer changes are probed again. 0 probes every time. (default: %(default)s)"
+        )
+        self.parser.add_argument(
+            "--probe-only",
+            dest="probe_only",
+            env_var='WIM_PROBE_ONLY',
+            action='store_true',
+            help="Don't install anything. Just find out, all at once, which slaves are reachable and ready, and what they have installed already."
+        )
+
+        # Output
+        self.parser.add_argument(
+            "--log-dir",
+            dest="log_dir",
+            env_var='WIM_LOG_DIR',
+            help="Directory to write the full output of each slave to, one file per slave. (default: <local_tmp_dir>/wim-logs)"
+        )
+        self.parser.add_argument(
+            "--console",
+            dest="console",
+            env_var='WIM_CONSOLE',
+            choices=[Console.MODE_LINES, Console.MODE_PROGRESS],
+            default=Console.MODE_LINES,
+            help="What to show on the console while installing: every line of output, labelled with its slave and step, or just how far the installation has got. (default: '%(default)s')"
+        )
+
+        # Several clusters
+        self.parser.add_argument(
+            "--clusters-file",
+            dest="clusters_file",
+            env_var='WIM_CLUSTERS_FILE',
+            help="INI file describing several clusters to install into at once: one section per cluster, named after it, setting any of these options (without the leading dashes). Options given here apply to every cluster, unless its section sets them too."
+        )
+        self.parser.add_argument(
+            "--clusters-parallelism",
+            dest="clusters_parallelism",
+            env_var='WIM_CLUSTERS_PARALLELISM',
+            type=int,
+            default=10,
+            help="With --clusters-file, how many slaves may be worked on at once across all the clusters. Each cluster being installed into counts for its own --parallelism. (default: %(default)s)"
+        )
+
+        # Dry run
+        self.parser.add_argument(
+            "--dry-run", "--plan",
+            dest="dry_run",
+            env_var='WIM_DRY_RUN',
+            action='store_true',
+            help="Don't install anything. Instead, write the plan (in JSON) of every remote command and file each slave would be sent, as if no slave had anything installed yet (unless it was probed within the last --facts-ttl seconds, in which case what was found out is used)."
+        )
+
+        # Parallelism
+        self.parser.add_argument(
+            "--parallelism",
+            dest="parallelism",
+            env_var='WIM_PARALLELISM',
+            type=int,
+            default=1,
+            help="Maximum number of slave nodes to install into at the same time. (default: %(default)s)"
+        )
+        self.parser.add_argument(
+            "--probe-parallelism",
+            dest="probe_parallelism",
+            env_var='WIM_PROBE_PARALLELISM',
+            type=int,
+            default=Installer.PROBE_PARALLELISM,
+            help="Maximum number of slave nodes to probe, or check the Weave mesh on, at the same time, if more than --parallelism. (default: %(default)s)"
+        )
+
+
+    def add_transport_arguments(self):
+
+        transport_group = self.parser.add_argument_group('transport', 'Transport')
+
+        # Transport
+        transport_group.add_argument(
+            "--transport",
+            dest="transport",
+            env_var='WIM_TRANSPORT',
+            choices=[Installer.TRANSPORT_SSH, Installer.TRANSPORT_LOCAL],
+            default=Installer.TRANSPORT_SSH,
+            help="How to reach slave nodes. The 'local' transport simulates each slave as a directory on this machine, for testing. (default: '%(default)s')"
+        )
+
+        # SSH connection reuse
+        transport_group.add_argument(
+            "--ssh-control-persist",
+            dest="ssh_control_persist",
+            env_var='WIM_SSH_CONTROL_PERSIST',
+            default="60s",
+            help="How long an idle shared SSH connection to a slave stays open between commands. (default: '%(default)s')"
+        )
+
+        # Timeouts, retries and quarantine
+        transport_group.add_argument(
+            "--ssh-connect-timeout",
+            dest="ssh_connect_timeout",
+            env_var='WIM_SSH_CONNECT_TIMEOUT',
+            type=int,
+            default=10,
+            help="Seconds to wait for an SSH connection to a slave to be made. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--operation-timeout",
+            dest="operation_timeout",
+            env_var='WIM_OPERATION_TIMEOUT',
+            type=int,
+            default=600,
+            help="Seconds any one remote operation may take before it is abandoned, as if the slave couldn't be reached. 0 waits forever. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--retries",
+            dest="retries",
+            env_var='WIM_RETRIES',
+            type=int,
+            default=3,
+            help="How many times to try a remote operation again when the slave couldn't be reached (or the operation timed out), waiting twice as long before each try. Mesos slave restarts are never tried again. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--retry-backoff",
+            dest="retry_backoff",
+            env_var='WIM_RETRY_BACKOFF',
+            type=float,
+            default=1.0,
+            help="Seconds to wait before the first retry of a remote operation, give or take a random half. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--circuit-breaker-threshold",
+            dest="circuit_breaker_threshold",
+            env_var='WIM_CIRCUIT_BREAKER_THRESHOLD',
+            type=int,
+            default=5,
+            help="How many times in a row a slave can't be reached before it is quarantined: nothing more is tried on it for the rest of the run. 0 never quarantines a slave. (default: %(default)s)"
+        )
+
+        # Local transport root
+        transport_group.add_argument(
+            "--local-transport-root",
+            dest="local_transport_root",
+            env_var='WIM_LOCAL_TRANSPORT_ROOT',
+            help="Directory holding one subdirectory per simulated slave for the 'local' transport. (default: <local_tmp_dir>/wim-local-cluster)"
+        )
+
+        # Local transport fault injection
+        transport_group.add_argument(
+            "--local-transport-latency",
+            dest="local_transport_latency",
+            env_var='WIM_LOCAL_TRANSPORT_LATENCY',
+            type=float,
+            default=0.0,
+            help="For the 'local' transport, seconds added to every remote operation, to simulate the round trip to a real slave. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--local-transport-failure-rate",
+            dest="local_transport_failure_rate",
+            env_var='WIM_LOCAL_TRANSPORT_FAILURE_RATE',
+            type=float,
+            default=0.0,
+            help="For the 'local' transport, the fraction (0 to 1) of remote operations that fail as if the connection to the slave had dropped. (default: %(default)s)"
+        )
+        transport_group.add_argument(
+            "--local-transport-random-seed",
+            dest="local_transport_random_seed",
+            env_var='WIM_LOCAL_TRANSPORT_RANDOM_SEED',
+            type=int,
+            help="For the 'local' transport, the seed for choosing which remote operations fail, to make a run repeatable."
+        )
+
+        # Executable distribution
+        transport_group.add_argument(
+            "--binary-distribution",
+            dest="binary_distribution",
+            env_var='WIM_BINARY_DISTRIBUTION',
+            choices=[Installer.DISTRIBUTION_DIRECT, Installer.DISTRIBUTION_TREE],
+            default=Installer.DISTRIBUTION_DIRECT,
+            help="How the Weave executables reach the slaves. With 'tree', a few slaves are sent them from here, and slaves that have them pass them on to the rest. Slaves must be able to reach each other with SSH, using the forwarded SSH agent. (default: '%(default)s')"
+        )
+        transport_group.add_argument(
+            "--fanout-degree",
+            dest="fanout_degree",
+            env_var='WIM_FANOUT_DEGREE',
+            type=int,
+            default=3,
+            help="For 'tree' distribution, how many slaves are sent the executables from here, and how many slaves each slave passes them on to at once. (default: %(default)s)"
+        )
+
 
     def add_mesos_arguments(self):
 
@@ -93,9 +399,9 @@ class Installer:
             "--mesos-flavor",
             dest="mesos_flavor",
             env_var='MESOS_FLAVOR',
-            choices=[Installer.FLAVOR_VANILLA, Installer.FLAVOR_DCOS],
-            default=Installer.FLAVOR_VANILLA,
-            help="The 'flavor' of Mesos to install into. Determines several default values. (default: '%(default)s')"
+            choices=[Installer.FLAVOR_AUTO, Installer.FLAVOR_VANILLA, Installer.FLAVOR_DCOS],
+            default=Installer.FLAVOR_AUTO,
+            help="The 'flavor' of Mesos to install into. Determines several default values. With 'auto', the flavor is found out on each slave, from the Mesos slave service it runs, so a cluster can mix flavors. (default: '%(default)s')"
         )
 
         # Nodes
@@ -114,6 +420,22 @@ class Installer:
             help="List of addresses of private Mesos slave nodes. Delimited by commas, colons, semicolons, pipes, or whitespace."
         )
 
+        # Slave discovery
+        mesos_group.add_argument(
+            "--mesos-slaves-url",
+            dest="mesos_slaves_url",
+            env_var='MESOS_SLAVES_URL',
+            help="URL of the Mesos master's /slaves endpoint (eg. 'http://leader.mesos:5050/slaves'), to install into every active slave it lists, instead of listing them with --mesos-public-slaves and --mesos-private-slaves. A 'file://' URL of a saved copy of its output works too."
+        )
+        mesos_group.add_argument(
+            "--mesos-inventory-ttl",
+            dest="mesos_inventory_ttl",
+            env_var='MESOS_INVENTORY_TTL',
+            type=int,
+            default=300,
+            help="How many seconds the slaves found at --mesos-slaves-url are remembered for, so that runs close together don't each ask the master. 0 asks every time. (default: %(default)s)"
+        )
+
         # Admin username
         mesos_group.add_argument(
             "--mesos-admin-username",
@@ -144,6 +466,46 @@ class Installer:
             help="Path for the Mesos executor environment config file. (default: Determined by 'flavor')"
         )
 
+        # Rolling restart
+        mesos_group.add_argument(
+            "--mesos-max-unavailable",
+            dest="mesos_max_unavailable",
+            env_var='MESOS_MAX_UNAVAILABLE',
+            type=int,
+            default=1,
+            help="Maximum number of Mesos slaves to restart at the same time. Public and private slaves are restarted in separate batches. (default: %(default)s)"
+        )
+        mesos_group.add_argument(
+            "--mesos-restart-timeout",
+            dest="mesos_restart_timeout",
+            env_var='MESOS_RESTART_TIMEOUT',
+            type=int,
+            default=300,
+            help="Seconds to wait for a restarted Mesos slave (and its Weave router) to become active again, before giving up on the rolling restart. (default: %(default)s)"
+        )
+        mesos_group.add_argument(
+            "--mesos-restart-strategy",
+            dest="mesos_restart_strategy",
+            env_var='MESOS_RESTART_STRATEGY',
+            choices=[Installer.RESTART_RECOVER, Installer.RESTART_DRAIN, Installer.RESTART_PLAIN],
+            default=Installer.RESTART_RECOVER,
+            help="How to restart Mesos slaves. 'recover' keeps their executors running through the restart, so that the slave recovers its tasks (for frameworks that checkpoint, as Marathon does). 'drain' first schedules maintenance for the slave with the Mesos master, and waits for its tasks to be moved elsewhere. 'restart' just restarts the slave, which kills its tasks. (default: '%(default)s')"
+        )
+        mesos_group.add_argument(
+            "--mesos-master-url",
+            dest="mesos_master_url",
+            env_var='MESOS_MASTER_URL',
+            help="URL of the Mesos master (eg. 'http://leader.mesos:5050'), for the 'drain' restart strategy. (default: --mesos-slaves-url without its '/slaves')"
+        )
+        mesos_group.add_argument(
+            "--mesos-drain-timeout",
+            dest="mesos_drain_timeout",
+            env_var='MESOS_DRAIN_TIMEOUT',
+            type=int,
+            default=600,
+            help="For the 'drain' restart strategy, seconds to wait for a Mesos slave's tasks to be moved elsewhere, before giving up on the rolling restart. (default: %(default)s)"
+        )
+
 
     def add_weave_arguments(self):
 
@@ -235,7 +597,7 @@ class Installer:
             "--weave-router-password",
             dest="weave_router_password",
             env_var='WEAVE_ROUTER_PASSWORD',
-            help="Router password"
+            help="Router password, given to the routers in each slave's environment file, which only root can read, rather than on their command line"
         )
 
         # nickname
@@ -254,6 +616,40 @@ class Installer:
             help="Router initial peer count"
         )
 
+        # Peer topology
+        weave_router_group.add_argument(
+            "--weave-router-seed-peers",
+            dest="weave_router_seed_peers",
+            env_var='WEAVE_ROUTER_SEED_PEERS',
+            type=int,
+            default=3,
+            help="On clusters too big for every router to be given every slave as a peer, how many slaves (the same for all) every router is given to connect to. (default: %(default)s)"
+        )
+
+        # Verification
+        weave_router_group.add_argument(
+            "--weave-router-convergence-timeout",
+            dest="weave_router_convergence_timeout",
+            env_var='WEAVE_ROUTER_CONVERGENCE_TIMEOUT',
+            type=int,
+            default=120,
+            help="Seconds to wait, once Weave is installed everywhere, for every router to see the whole mesh and its IP address manager to be ready. 0 skips the check. (default: %(default)s)"
+        )
+        weave_router_group.add_argument(
+            "--mesh-report-file",
+            dest="mesh_report_file",
+            env_var='WIM_MESH_REPORT_FILE',
+            help="Path for a JSON Lines report of how each Weave router saw the mesh, with a summary (including outliers) on the last line. (default: <local_tmp_dir>/wim-mesh.jsonl)"
+        )
+        weave_router_group.add_argument(
+            "--weave-router-ring-peers",
+            dest="weave_router_ring_peers",
+            env_var='WEAVE_ROUTER_RING_PEERS',
+            type=int,
+            default=2,
+            help="On clusters too big for every router to be given every slave as a peer, how many more slaves (different for each) every router is given to connect to. (default: %(default)s)"
+        )
+
 
     def add_weave_proxy_arguments(self):
 
@@ -312,9 +708,34 @@ class Installer:
 
 
     def add_weave_scope_arguments(self):
-        # TODO: Add some options here
-        # weave_scope_group = self.parser.add_argument_group('weave-scope', 'Weave Scope')
-        pass
+
+        weave_scope_group = self.parser.add_argument_group('weave-scope', 'Weave Scope')
+
+        # Deployment mode
+        weave_scope_group.add_argument(
+            "--weave-scope-mode",
+            dest="weave_scope_mode",
+            env_var='WEAVE_SCOPE_MODE',
+            choices=[Installer.SCOPE_MODE_STANDALONE, Installer.SCOPE_MODE_CENTRAL],
+            default=Installer.SCOPE_MODE_STANDALONE,
+            help="How to deploy Weave Scope. 'standalone' runs the Scope app, and a probe reporting to it, on every slave. 'central' runs the app on a few slaves only, and just a probe on the rest, reporting to those. (default: '%(default)s')"
+        )
+
+        # App slaves
+        weave_scope_group.add_argument(
+            "--weave-scope-app-slaves",
+            dest="weave_scope_app_slaves",
+            env_var='WEAVE_SCOPE_APP_SLAVES',
+            help="In 'central' mode, comma-separated list of the slaves to run the Scope app on. (default: --weave-scope-app-count slaves, chosen by hashing their addresses)"
+        )
+        weave_scope_group.add_argument(
+            "--weave-scope-app-count",
+            dest="weave_scope_app_count",
+            env_var='WEAVE_SCOPE_APP_COUNT',
+            type=int,
+            default=1,
+            help="In 'central' mode, how many slaves to run the Scope app on, unless --weave-scope-app-slaves names them. (default: %(default)s)"
+        )
 
 
     def is_valid_mesos_flavor(self, name):
@@ -322,6 +743,8 @@ class Installer:
             return True
         if name == Installer.FLAVOR_DCOS:
             return True
+        if name == Installer.FLAVOR_AUTO:
+            return True
         return False
 
 
@@ -329,38 +752,50 @@ class Installer:
 
         # Vanilla flavor
         if self.args.mesos_flavor == Installer.FLAVOR_VANILLA:
-            self.default_arguments_vanilla()
+            self.default_arguments_vanilla(self.args)
 
         # DCOS flavor
         elif self.args.mesos_flavor == Installer.FLAVOR_DCOS:
-            self.default_arguments_dcos()
+            self.default_arguments_dcos(self.args)
+
+        # Flavor found out on each slave. The admin user is needed to reach the slaves at all, so it's the same on all
+        # of them, but the rest defaults according to the flavor found on each slave.
+        elif self.args.mesos_admin_username is None:
+            self.args.mesos_admin_username = pwd.getpwuid(os.getuid()).pw_name
+
+        # The options of each flavor, for slaves found to run it
+        self.flavor_args = {}
+        for flavor, default_arguments in [(Installer.FLAVOR_VANILLA, self.default_arguments_vanilla), (Installer.FLAVOR_DCOS, self.default_arguments_dcos)]:
+            self.flavor_args[flavor] = copy.copy(self.args)
+            default_arguments(self.flavor_args[flavor])
 
         # Let Weave installation directory default to the home directory of the Mesos admin user
         if self.args.weave_install_dir is None:
             self.args.weave_install_dir = "/home/" + self.args.mesos_admin_username
 
 
-    def default_arguments_vanilla(self):
-        raise Exception("Not yet implemented. Someone needs to determine the defaults for 'vanilla' Mesos flavor")
-        # if self.args.mesos_admin_username is None:
-        #     self.args.mesos_admin_username = "TBD"
-        # if self.args.mesos_slave_service_name_public is None:
-        #     self.args.mesos_slave_service_name_public = "TBD"
-        # if self.args.mesos_slave_service_name_private is None:
-        #     self.args.mesos_slave_service_name_private = "TBD"
-        # if self.args.mesos_slave_executor_env_file is None:
-        #     self.args.mesos_slave_executor_env_file = "TBD"
+    def default_arguments_vanilla(self, args):
+        # Vanilla Mesos has no admin user of its own, and public slaves are just slaves with a different role. The
+        # packages' init wrapper turns each file in /etc/mesos-slave into the command line flag it's named after.
+        if args.mesos_admin_username is None:
+            args.mesos_admin_username = pwd.getpwuid(os.getuid()).pw_name
+        if args.mesos_slave_service_name_public is None:
+            args.mesos_slave_service_name_public = "mesos-slave.service"
+        if args.mesos_slave_service_name_private is None:
+            args.mesos_slave_service_name_private = "mesos-slave.service"
+        if args.mesos_slave_executor_env_file is None:
+            args.mesos_slave_executor_env_file = "/etc/mesos-slave/executor_environment_variables"
 
 
-    def default_arguments_dcos(self):
-        if self.args.mesos_admin_username is None:
-            self.args.mesos_admin_username = "core"
-        if self.args.mesos_slave_service_name_public is None:
-            self.args.mesos_slave_service_name_public = "dcos-mesos-slave-public.service"
-        if self.args.mesos_slave_service_name_private is None:
-            self.args.mesos_slave_service_name_private = "dcos-mesos-slave.service"
-        if self.args.mesos_slave_executor_env_file is None:
-            self.args.mesos_slave_executor_env_file = "/opt/mesosphere/etc/mesos-executor-environment.json"
+    def default_arguments_dcos(self, args):
+        if args.mesos_admin_username is None:
+            args.mesos_admin_username = "core"
+        if args.mesos_slave_service_name_public is None:
+            args.mesos_slave_service_name_public = "dcos-mesos-slave-public.service"
+        if args.mesos_slave_service_name_private is None:
+            args.mesos_slave_service_name_private = "dcos-mesos-slave.service"
+        if args.mesos_slave_executor_env_file is None:
+            args.mesos_slave_executor_env_file = "/opt/mesosphere/etc/mesos-executor-environment.json"
 
 
     def process_arguments(self):
@@ -369,6 +804,13 @@ class Installer:
         self.mesos_public_slaves = parse_delimited_list(self.args.mesos_public_slaves)
         self.mesos_private_slaves = parse_delimited_list(self.args.mesos_private_slaves)
 
+        # Or find them by asking the Mesos master
+        if self.args.mesos_slaves_url is not None:
+            if len(self.mesos_public_slaves) != 0 or len(self.mesos_private_slaves) != 0:
+                raise ValueError("You must specify either --mesos-slaves-url or --mesos-public-slaves and --mesos-private-slaves (not both)")
+            cache_file_path = self.args.local_tmp_dir + "/wim-inventory.json"
+            self.mesos_public_slaves, self.mesos_private_slaves = discover_slaves(self.args.mesos_slaves_url, cache_file_path, self.args.mesos_inventory_ttl)
+
         # Make sure at least one slave node was specified
         if (len(self.mesos_public_slaves) == 0 and len(self.mesos_private_slaves) == 0):
             raise ValueError("You must specify at least one Mesos slave node using --mesos-public-slaves or --mesos_private_slaves")
@@ -387,7 +829,6 @@ class Installer:
 
         # Build directory paths for use later
         self.weave_bin_dir = self.args.weave_install_dir + "/bin"
-        self.weave_tmp_dir = self.args.weave_install_dir + "/tmp"
 
         # Append "." to DNS domain, if it's not already there
         if not self.args.domain is None and not self.args.domain.endswith("."):
@@ -396,28 +837,128 @@ class Installer:
         # Map skip-warnings string to boolean
         self.skip_warnings = is_truthy(self.args.skip_warnings)
 
+        # Validate parallelism
+        if self.args.parallelism < 1:
+            raise ValueError("Invalid parallelism: " + str(self.args.parallelism) + " (must be at least 1)")
+        if self.args.probe_parallelism < 1:
+            raise ValueError("Invalid probe-parallelism: " + str(self.args.probe_parallelism) + " (must be at least 1)")
+        if self.args.local_transport_latency < 0:
+            raise ValueError("Invalid local-transport-latency: " + str(self.args.local_transport_latency) + " (must not be negative)")
+        if not 0 <= self.args.local_transport_failure_rate <= 1:
+            raise ValueError("Invalid local-transport-failure-rate: " + str(self.args.local_transport_failure_rate) + " (must be between 0 and 1)")
+        if self.args.weave_router_seed_peers < 1:
+            raise ValueError("Invalid weave-router-seed-peers: " + str(self.args.weave_router_seed_peers) + " (must be at least 1)")
+        if self.args.weave_router_ring_peers < 0:
+            raise ValueError("Invalid weave-router-ring-peers: " + str(self.args.weave_router_ring_peers) + " (must not be negative)")
+        if self.args.fanout_degree < 1:
+            raise ValueError("Invalid fanout-degree: " + str(self.args.fanout_degree) + " (must be at least 1)")
+        if self.args.mesos_max_unavailable < 1:
+            raise ValueError("Invalid mesos-max-unavailable: " + str(self.args.mesos_max_unavailable) + " (must be at least 1)")
+        if self.args.weave_router_convergence_timeout < 0:
+            raise ValueError("Invalid weave-router-convergence-timeout: " + str(self.args.weave_router_convergence_timeout) + " (must not be negative)")
+        if self.args.mesos_drain_timeout < 1:
+            raise ValueError("Invalid mesos-drain-timeout: " + str(self.args.mesos_drain_timeout) + " (must be at least 1)")
+        if self.args.weave_scope_app_count < 1:
+            raise ValueError("Invalid weave-scope-app-count: " + str(self.args.weave_scope_app_count) + " (must be at least 1)")
+        for slave in parse_delimited_list(self.args.weave_scope_app_slaves):
+            if not slave in self.mesos_public_slaves and not slave in self.mesos_private_slaves:
+                raise ValueError("Invalid weave-scope-app-slaves: " + slave + " (must be one of the Mesos slaves)")
+
+        # Draining slaves takes the Mesos master, which the URL of its slaves endpoint leads to
+        slaves_url = self.args.mesos_slaves_url
+        if self.args.mesos_master_url is None and slaves_url is not None and slaves_url.endswith("/slaves"):
+            self.args.mesos_master_url = slaves_url[:-len("/slaves")]
+        if self.args.mesos_restart_strategy == Installer.RESTART_DRAIN and self.args.mesos_master_url is None:
+            raise ValueError("You must specify --mesos-master-url (or --mesos-slaves-url) to drain Mesos slaves before restarting them")
+
+        # Only one thread at a time may change the Mesos master's maintenance schedule
+        self.maintenance_lock = threading.Lock()
+        if self.args.ssh_connect_timeout < 1:
+            raise ValueError("Invalid ssh-connect-timeout: " + str(self.args.ssh_connect_timeout) + " (must be at least 1)")
+        if self.args.operation_timeout < 0:
+            raise ValueError("Invalid operation-timeout: " + str(self.args.operation_timeout) + " (must not be negative)")
+        if self.args.retries < 0:
+            raise ValueError("Invalid retries: " + str(self.args.retries) + " (must not be negative)")
+        if self.args.retry_backoff < 0:
+            raise ValueError("Invalid retry-backoff: " + str(self.args.retry_backoff) + " (must not be negative)")
+        if self.args.circuit_breaker_threshold < 0:
+            raise ValueError("Invalid circuit-breaker-threshold: " + str(self.args.circuit_breaker_threshold) + " (must not be negative)")
+
+        # Only one thread at a time may ask the user whether to proceed
+        self.proceed_lock = threading.Lock()
+
+        # Every remote operation is timed and recorded here
+        if self.args.report_file is None:
+            self.args.report_file = self.args.local_tmp_dir + "/wim-report.jsonl"
+        self.report = RunReport()
+
+        # When planning, remote operations are recorded here instead of run
+        self.plan = None
+
+        # Steps completed on each slave by an earlier run, if we're resuming one, and by this one
+        if self.args.journal_file is None:
+            self.args.journal_file = self.args.local_tmp_dir + "/wim-journal.jsonl"
+        self.journal = Journal()
+
+        # How the Weave routers saw the mesh, and when each was last (re)started
+        if self.args.mesh_report_file is None:
+            self.args.mesh_report_file = self.args.local_tmp_dir + "/wim-mesh.jsonl"
+        self.router_started = {}
+        self.mesh_converged = True
+
+        # Slaves that keep failing to be reached are given up on
+        self.circuit_breaker = CircuitBreaker(self.args.circuit_breaker_threshold)
+
+        # What was found out about each slave recently
+        self.facts_cache = FactsCache(self.args.local_tmp_dir + "/wim-facts.json", self.args.facts_ttl)
+        self.facts = {}
+
+        # The full output of each slave goes here
+        if self.args.log_dir is None:
+            self.args.log_dir = self.args.local_tmp_dir + "/wim-logs"
+
         # Build the Weave systemd service file substitution maps
         self.build_weave_router_substitutions()
         self.build_weave_proxy_substitutions()
         self.build_weave_scope_substitutions()
 
+        # Check the service templates against their substitutions now, rather than on every slave
+        render_file("./weave-router.service", self.weave_router_substitutions)
+        render_file("./weave-proxy.service", self.weave_proxy_substitutions)
+        for substitutions in self.weave_scope_substitutions.values():
+            render_file("./weave-scope.service", substitutions)
+
 
     def build_weave_router_substitutions(self):
 
         substitutions = []
 
+        # Each router is given the peers to connect to at first; it learns about the rest from them. Once a router
+        # can't be given every slave, IP address allocation needs to be told how many there are.
+        slaves = self.mesos_private_slaves + self.mesos_public_slaves
+        self.weave_router_peers = plan_peers(slaves, self.args.weave_router_seed_peers, self.args.weave_router_ring_peers)
+        self.weave_router_init_peer_count = plan_init_peer_count(slaves, self.weave_router_peers, self.args.weave_router_init_peer_count)
+
+        # The peers differ between slaves, and the initial peer count changes with the cluster's size, so both come from
+        # each slave's environment file, which keeps the service file the same for all
         self.append_substitution(substitutions, "{{BIN_DIR}}", self.weave_bin_dir)
-        weave_router_peers = ' '.join(self.mesos_private_slaves + self.mesos_public_slaves)
-        self.append_substitution(substitutions, "{{PEERS}}", weave_router_peers)
+        self.append_substitution(substitutions, "{{PEERS}}", "$WEAVE_ROUTER_PEERS")
         self.append_substitution(substitutions, "{{IPALLOC_RANGE}}", self.args.weave_router_ipalloc_range, option="--ipalloc-range")
         self.append_substitution(substitutions, "{{DNS_DOMAIN}}", self.args.domain, option="--dns-domain")
-        self.append_substitution(substitutions, "{{PASSWORD}}", self.args.weave_router_password, option="--password")
         self.append_substitution(substitutions, "{{NICKNAME}}", self.args.weave_router_nickname, option="--nickname")
-        self.append_substitution(substitutions, "{{INIT_PEER_COUNT}}", self.args.weave_router_init_peer_count, option="--init-peer-count")
+        if self.weave_router_init_peer_count is not None:
+            self.append_substitution(substitutions, "{{INIT_PEER_COUNT}}", "$" + INIT_PEER_COUNT_VARIABLE, option="--init-peer-count")
+        else:
+            self.append_substitution(substitutions, "{{INIT_PEER_COUNT}}", None)
 
         self.weave_router_substitutions = substitutions
 
 
+    def weave_router_environment(self, slave):
+        # The settings for the given slave's Weave router that differ between slaves, or mustn't be seen by everyone
+        return router_environment(self.weave_router_peers[slave], self.args.weave_router_password, self.weave_router_init_peer_count)
+
+
     def build_weave_proxy_substitutions(self):
 
         substitutions = []
@@ -437,11 +978,29 @@ class Installer:
 
     def build_weave_scope_substitutions(self):
 
-        substitutions = []
+        # Standalone, every slave runs the app and a probe reporting to it. Central, only the app slaves do, and every
+        # probe (theirs included) reports to all of the apps, so that each app sees the whole cluster.
+        slaves = self.mesos_public_slaves + self.mesos_private_slaves
+        if self.args.weave_scope_mode == Installer.SCOPE_MODE_CENTRAL:
+            self.weave_scope_apps = plan_scope_apps(slaves, parse_delimited_list(self.args.weave_scope_app_slaves), self.args.weave_scope_app_count)
+            apps = " ".join(self.weave_scope_apps)
+        else:
+            self.weave_scope_apps = list(slaves)
+            apps = None
 
-        self.append_substitution(substitutions, "{{BIN_DIR}}", self.weave_bin_dir)
+        # The service file is rendered once for each role, and is the same on every slave in it
+        self.weave_scope_substitutions = {}
+        for role in [Installer.SCOPE_ROLE_APP, Installer.SCOPE_ROLE_PROBE]:
+            substitutions = []
+            self.append_substitution(substitutions, "{{BIN_DIR}}", self.weave_bin_dir)
+            self.append_substitution(substitutions, "{{NO_APP}}", "--no-app" if role == Installer.SCOPE_ROLE_PROBE else None)
+            self.append_substitution(substitutions, "{{APPS}}", apps)
+            self.weave_scope_substitutions[role] = substitutions
 
-        self.weave_scope_substitutions = substitutions
+
+    def weave_scope_role(self, slave):
+        # Whether the given slave runs the Scope app, or just a probe
+        return Installer.SCOPE_ROLE_APP if slave in self.weave_scope_apps else Installer.SCOPE_ROLE_PROBE
 
 
     def append_substitution(self, substutitions, pattern, value, **kwargs):
@@ -454,289 +1013,2469 @@ class Installer:
         substutitions.append({'pattern': pattern, 'replacement': replacement})
 
 
+    def create_transport(self):
+
+        if self.args.transport == Installer.TRANSPORT_LOCAL:
+            root = self.args.local_transport_root
+            if root is None:
+                root = self.args.local_tmp_dir + "/wim-local-cluster"
+            return LocalTransport(
+                root,
+                latency=self.args.local_transport_latency,
+                failure_rate=self.args.local_transport_failure_rate,
+                random_seed=self.args.local_transport_random_seed
+            )
+
+        # Slaves can only pass executables on to each other with the agent forwarded to them
+        forward_agent = (self.args.binary_distribution == Installer.DISTRIBUTION_TREE)
+        return SshTransport(
+            self.args.mesos_admin_username,
+            self.args.ssh_control_persist,
+            connect_timeout=self.args.ssh_connect_timeout,
+            forward_agent=forward_agent
+        )
+
+
+    # Where each cluster's run writes its output, and the variables that could set them, which aren't passed on from
+    # the command line or the environment, so that clusters don't write over each other's files
+    CLUSTER_OUTPUT_OPTIONS = [
+        ("--report-file", "WIM_REPORT_FILE"),
+        ("--journal-file", "WIM_JOURNAL_FILE"),
+        ("--log-dir", "WIM_LOG_DIR"),
+        ("--mesh-report-file", "WIM_MESH_REPORT_FILE")
+    ]
+
+    def install_clusters(self):
+
+        # Each cluster is installed into by a run of the installer of its own, with its own temporary directory
+        if self.args.clusters_parallelism < 1:
+            raise ValueError("Invalid clusters-parallelism: " + str(self.args.clusters_parallelism) + " (must be at least 1)")
+        clusters = self.read_clusters_file(self.args.clusters_file)
+        for cluster in clusters:
+            cluster['args'] = self.parser.parse_args(cluster['arguments'], env_vars=self.cluster_environment())
+
+        # Each takes up as much of the budget of slaves as it installs into at once, and probes no more than that at
+        # once either, so that its probes stay within the budget too
+        for cluster in clusters:
+            cluster['weight'] = min(cluster['args'].parallelism, self.args.clusters_parallelism)
+            cluster['arguments'] += ["--probe-parallelism", str(min(cluster['args'].probe_parallelism, cluster['weight']))]
+
+        # Ask once for all of them, rather than have every run ask its own questions at once
+        self.skip_warnings = is_truthy(self.args.skip_warnings)
+        self.proceed_lock = threading.Lock()
+        if not self.args.dry_run and not self.args.probe_only:
+            if not self.proceed("Are you sure you want to install Weave into " + str(len(clusters)) + " clusters (" + ", ".join(cluster['name'] for cluster in clusters) + "), restarting their Mesos slaves?"):
+                return
+
+        # Install into as many at once as the budget of slaves allows
+        if self.args.log_dir is None:
+            self.args.log_dir = self.args.local_tmp_dir + "/wim-logs"
+        budget = ConcurrencyBudget(self.args.clusters_parallelism)
+        def install(cluster):
+            budget.acquire(cluster['weight'])
+            try:
+                return self.install_cluster(cluster)
+            finally:
+                budget.release(cluster['weight'])
+
+        console.start(self.args.log_dir, Console.MODE_LINES)
+        try:
+            announce("Installing into " + str(len(clusters)) + " clusters")
+            results = run_in_parallel(clusters, install, len(clusters))
+        finally:
+            console.stop()
+        self.print_clusters_summary(results)
+
+        # Report where the time went, across all the clusters
+        if self.args.report_file is None:
+            self.args.report_file = self.args.local_tmp_dir + "/wim-report.jsonl"
+        self.report = RunReport()
+        for cluster in clusters:
+            report_file = cluster['args'].report_file or cluster['args'].local_tmp_dir + "/wim-report.jsonl"
+            if not os.path.exists(report_file):
+                continue
+            with open(report_file, "r") as source:
+                for record in map(json.loads, source):
+                    record['cluster'] = cluster['name']
+                    record['host'] = cluster['name'] + "/" + record['host']
+                    self.report.records.append(record)
+        self.report.write(self.args.report_file)
+        self.report.print_summary()
+        print "Report of every remote operation, in every cluster, written to: " + self.args.report_file
+
+        if any(result.error is not None or result.value != 0 for result in results):
+            sys.exit(1)
+
+
+    def read_clusters_file(self, file_path):
+
+        if not os.path.exists(file_path):
+            raise ValueError("Invalid clusters-file: " + file_path + " (does not exist)")
+        config = ConfigParser.RawConfigParser()
+        try:
+            config.read(file_path)
+        except ConfigParser.Error as e:
+            raise ValueError("Invalid clusters-file: " + file_path + " (" + str(e).strip() + ")")
+        if len(config.sections()) == 0:
+            raise ValueError("Invalid clusters-file: " + file_path + " (must describe at least one cluster)")
+
+        # Options given on the command line come first, so that a cluster's own options override them
+        common_arguments = strip_option(sys.argv[1:], "--clusters-file")
+        for option, _ in Installer.CLUSTER_OUTPUT_OPTIONS:
+            common_arguments = strip_option(common_arguments, option)
+        clusters = []
+        for name in config.sections():
+            arguments = list(common_arguments)
+            arguments += ["--local-tmp-dir", self.args.local_tmp_dir + "/wim-clusters/" + name]
+            for key, value in config.items(name):
+                action = self.parser._option_string_actions.get("--" + key)
+                if action is None or key in ["clusters-file", "clusters-parallelism"]:
+                    raise ValueError("Invalid clusters-file: " + file_path + " (unknown option '" + key + "' for cluster '" + name + "')")
+                if action.nargs == 0:
+                    if is_truthy(value):
+                        arguments.append("--" + key)
+                else:
+                    arguments += ["--" + key, value]
+            arguments += ["--skip-warnings", "yes"]
+            clusters.append({'name': name, 'arguments': arguments})
+        return clusters
+
+
+    def install_cluster(self, cluster):
+
+        # Run the installer for the cluster, passing on its output, or (when planning) writing its plan to a file
+        args = cluster['args']
+        if not os.path.isdir(args.local_tmp_dir):
+            os.makedirs(args.local_tmp_dir)
+        environment = self.cluster_environment()
+        command = [sys.executable, os.path.abspath(sys.argv[0])] + cluster['arguments']
+        log(cluster['name'], "Installing into cluster (" + args.mesos_flavor + "), in " + args.local_tmp_dir)
+        if self.args.dry_run:
+            plan_file_path = args.local_tmp_dir + "/wim-plan.json"
+            with open(plan_file_path, "w") as plan_file:
+                result = call_logged(cluster['name'], command, stdout=plan_file, env=environment)
+            log(cluster['name'], "Plan written to: " + plan_file_path)
+        else:
+            result = call_logged(cluster['name'], command, env=environment)
+        log(cluster['name'], "Finished " + ("successfully" if result == 0 else "with exit code " + str(result)))
+        return result
+
+
+    def cluster_environment(self):
+
+        # The environment for each cluster's run: this one's, less what would make it install into several clusters
+        # itself, or write to the same files as the others
+        environment = dict(os.environ)
+        environment.pop('WIM_CLUSTERS_FILE', None)
+        for _, variable in Installer.CLUSTER_OUTPUT_OPTIONS:
+            environment.pop(variable, None)
+        return environment
+
+
+    def print_clusters_summary(self, results):
+
+        print "=================================================================="
+        succeeded = [result for result in results if result.error is None and result.value == 0]
+        print "Clusters summary: {0} succeeded, {1} failed".format(len(succeeded), len(results) - len(succeeded))
+        for result in results:
+            cluster = result.item
+            if result.error is not None:
+                status, detail = "FAILED", str(result.error)
+            elif result.value != 0:
+                status, detail = "FAILED", "exit code " + str(result.value)
+            else:
+                status, detail = "OK", ""
+            print "  {0:8}{1} ({2}) {3:.1f}s {4}".format(status, cluster['name'], cluster['args'].mesos_flavor, result.elapsed, detail).rstrip()
+
+
     def install(self):
 
-        # Install to public Mesos slaves
-        for slave in self.mesos_public_slaves:
-            self.install_into_slave(slave, is_public=True)
+        # Public Mesos slaves go first, then private ones
+        slaves = [(slave, True) for slave in self.mesos_public_slaves]
+        slaves += [(slave, False) for slave in self.mesos_private_slaves]
+
+        # Find out what every slave has already, all at once, before changing any of them. Those that can't be reached
+        # (or aren't ready) are left out of the rest of the installation.
+        probes = self.probe_slaves(slaves)
+        failed_probes = dict((result.item, result) for result in probes if result.error is not None)
+        slaves = [result.item for result in probes if result.error is None]
+
+        # Get the executables out to the slaves first, if they are to pass them on to each other. This remembers which
+        # executables changed on which slaves, since the services that run them still need restarting.
+        # Executables distributed by the run being resumed only count if they're the ones being installed, and no
+        # installation into the slave (which restarted their services) has been completed since.
+        self.distributed_paths = {}
+        fingerprint = self.executables_payload().fingerprint()
+        for slave, _ in slaves:
+            entry = self.journal.completed(slave, "distribute-executables", fingerprint)
+            installed = self.journal.completed(slave, "install-files")
+            if entry is not None and (installed is None or installed['sequence'] < entry['sequence']):
+                self.distributed_paths[slave] = set(entry['paths'])
+        if self.args.binary_distribution == Installer.DISTRIBUTION_TREE:
+            self.distribute_binaries([slave for slave, _ in slaves])
+
+        # Install into as many slaves at once as we were told to
+        console.set_total(len(slaves))
+        results = run_in_parallel(slaves, self.install_into_slave_safely, self.args.parallelism)
+
+        # Say where the Scope app can be found, and whether any slave meant to run it couldn't be installed into
+        if self.args.weave_with_scope and self.args.weave_scope_mode == Installer.SCOPE_MODE_CENTRAL and self.plan is None:
+            self.announce_scope_apps(results + failed_probes.values())
+
+        # Make sure the Weave routers found each other, and see how long that took, before touching the Mesos slaves
+        if self.args.weave_with_router and self.plan is None and self.args.weave_router_convergence_timeout != 0:
+            self.verify_mesh([result.item[0] for result in results if result.error is None])
+
+        # Then restart the Mesos slaves whose configuration changed, a few at a time
+        self.restart_slaves([result for result in results if result.error is None and result.value])
+
+        # Report on every slave, in order, including those that failed the probe
+        installs = dict((result.item, result) for result in results)
+        return [failed_probes.get(result.item) or installs[result.item] for result in probes]
+
+
+    def probe_only(self):
+
+        # Probe every slave, then show what was found
+        slaves = [(slave, True) for slave in self.mesos_public_slaves]
+        slaves += [(slave, False) for slave in self.mesos_private_slaves]
+        results = self.probe_slaves(slaves)
+        payload, _, _ = self.build_slave_payload(slaves[0][0])
+        console.flush()
+        print "=================================================================="
+        print "  {0:30} {1:30} {2:>7} {3:>6} {4:>10} {5:>11} {6:>9}".format("slave", "hostname", "flavor", "docker", "files", "DOCKER_HOST", "free MB")
+        for result in results:
+            slave = result.item[0]
+            facts = self.facts.get(slave)
+            if facts is None:
+                print "  {0:30} {1}".format(slave, "FAILED: " + str(result.error))
+                continue
+            up_to_date = len(payload.paths()) - len(payload.changed_paths(facts['digests']))
+            print "  {0:30} {1:30} {2:>7} {3:>6} {4:>10} {5:>11} {6:>9}".format(
+                slave,
+                facts['hostname'],
+                facts['flavor'],
+                "yes" if facts['docker_active'] else "no",
+                str(up_to_date) + "/" + str(len(payload.paths())) + " ok",
+                "yes" if facts['executor_env'] is not None and "DOCKER_HOST" in facts['executor_env'] else "no",
+                "?" if facts['free_kb'] is None else str(facts['free_kb'] / 1024)
+            )
+        return results
+
+
+    # Slaves probed at once by default, however few are installed into at once, since probing changes nothing
+    PROBE_PARALLELISM = 32
+
+    # The flavor of Mesos a slave is planned for, if we were told to find it out but the slave hasn't been probed
+    PLAN_FLAVOR = FLAVOR_DCOS
+
+    def probe_slaves(self, slaves):
+
+        # Every slave is asked for the same files (the environment file's name depends on its hostname)
+        payload, _, router_service = self.build_slave_payload(slaves[0][0])
+        paths = payload.paths()
+        if router_service is not None:
+            paths.append(WEAVE_HOST_ENV_FILE.replace("%H", "$(hostname)"))
+        executables = [file for file in payload.files if file['path'].startswith(self.weave_bin_dir + "/")]
+
+        # What was found out depends on what was asked, so facts found out with other options aren't used
+        inputs = {
+            'admin_user': self.args.mesos_admin_username,
+            'paths': paths,
+            'flavor': self.args.mesos_flavor,
+            'service_names': [self.args.mesos_slave_service_name_public, self.args.mesos_slave_service_name_private],
+            'executor_env_file': self.args.mesos_slave_executor_env_file,
+            'router': self.args.weave_with_router
+        }
+
+        def probe(item):
+            slave, is_public = item
+            slave_inputs = dict(inputs, public=is_public)
+            facts = self.facts_cache.get(slave, slave_inputs)
+            if facts is None:
+                if self.plan is not None:
+                    # When planning, a slave that hasn't been probed lately is taken to be new. If it's the slave that
+                    # would tell us which flavor of Mesos it runs, it's taken to run the flavor that used to be the default.
+                    flavor = self.args.mesos_flavor
+                    if flavor == Installer.FLAVOR_AUTO:
+                        flavor = Installer.PLAN_FLAVOR
+                    args = self.flavor_args[flavor]
+                    facts = {
+                        'hostname': slave, 'docker_active': True, 'digests': {}, 'free_kb': None,
+                        'flavor': flavor,
+                        'flavor_assumed': flavor != self.args.mesos_flavor,
+                        'mesos_service': args.mesos_slave_service_name_public if is_public else args.mesos_slave_service_name_private,
+                        'executor_env_file': args.mesos_slave_executor_env_file,
+                        'executor_env': ""
+                    }
+                else:
+                    facts = self.probe_slave(slave, is_public, paths)
+                    self.facts_cache.put(slave, facts, slave_inputs)
+            else:
+                log(slave, "Using what was found out about the slave {0:.0f} seconds ago".format(time.time() - facts['time']))
+            self.facts[slave] = facts
+
+            # Don't go any further with a slave that the installation would fail on anyway
+            if self.args.weave_with_router and not facts['docker_active']:
+                raise Exception("Docker is not running")
+            needed = sum(len(file['content']) for file in executables if facts['digests'].get(file['path']) != file['digest'])
+            if facts['free_kb'] is not None and facts['free_kb'] * 1024 < needed:
+                raise Exception("Not enough space for the Weave executables in " + self.weave_bin_dir + ": " + str(facts['free_kb']) + "KB free, " + str(needed / 1024) + "KB needed")
+
+        def probe_safely(item):
+            try:
+                probe(item)
+            except Exception as e:
+                log(item[0], "Probe failed: " + str(e))
+                raise
+
+        announce("Probing " + str(len(slaves)) + " slaves")
+        start = time.time()
+        results = run_in_parallel(slaves, probe_safely, max(self.args.parallelism, self.args.probe_parallelism))
+        failed = [result.item[0] for result in results if result.error is not None]
+        announce("Probed {0} slaves in {1:.1f}s{2}".format(
+            len(slaves), time.time() - start, "" if len(failed) == 0 else ", leaving out " + str(len(failed)) + " that failed: " + ", ".join(failed)
+        ))
+        return results
+
+
+    def probe_slave(self, slave, is_public, paths):
+
+        # Unless we were told which flavor of Mesos the slave runs, find out from its Mesos slave service, and read
+        # the executor environment file of every flavor it might be
+        detect = (self.args.mesos_flavor == Installer.FLAVOR_AUTO)
+        candidates = [self.flavor_args[Installer.FLAVOR_DCOS], self.flavor_args[Installer.FLAVOR_VANILLA]] if detect else [self.args]
+        executor_env_files = []
+        for args in candidates:
+            if not args.mesos_slave_executor_env_file in executor_env_files:
+                executor_env_files.append(args.mesos_slave_executor_env_file)
+
+        # Ask for everything with one command, each fact after a marker line
+        facts_commands = [
+            ("hostname", "hostname"),
+            ("docker", "systemctl is-active docker.service"),
+            ("digests", "sudo sha256sum " + " ".join(paths) + " 2>/dev/null"),
+            ("free-kb", "dir=" + pipes.quote(self.weave_bin_dir) + "; while [ ! -d \"$dir\" ]; do dir=$(dirname \"$dir\"); done; df -Pk \"$dir\" | awk 'NR == 2 { print $4 }'")
+        ]
+        if self.args.weave_with_router:
+            environment_path = WEAVE_HOST_ENV_FILE.replace("%H", "$(hostname)")
+            facts_commands.append(("router-env", "sudo grep -v '^" + INIT_PEER_COUNT_VARIABLE + "=' " + environment_path + " 2>/dev/null | sha256sum"))
+        if detect:
+            unit_dirs = " ".join(MESOS_SLAVE_UNIT_DIRS)
+            facts_commands.append(("mesos-services", "ls " + unit_dirs + " 2>/dev/null | grep -x -F" + "".join(" -e " + service for service in MESOS_SLAVE_SERVICES)))
+        for index, path in enumerate(executor_env_files):
+            facts_commands.append(("executor-env-" + str(index), "{ sudo cat " + pipes.quote(path) + " && echo; } 2>/dev/null || echo " + PROBE_MISSING_MARKER))
+        command = "; ".join("echo " + PROBE_MARKER + " " + name + "; " + fact_command for name, fact_command in facts_commands) + "; true"
+        lines = self.read_remotely(slave, command, step="probe")
+        sections = {}
+        current = None
+        for line in lines:
+            if line.startswith(PROBE_MARKER + " "):
+                current = sections.setdefault(line.split()[1], [])
+            elif current is not None:
+                current.append(line)
+        if len(sections.get('hostname', [])) == 0:
+            raise Exception("Could not get the hostname of the slave")
+
+        # The flavor decides which Mesos slave service to restart (unless we were told), and which file to configure
+        if detect:
+            flavor, service = detect_mesos_flavor([line.strip() for line in sections.get('mesos-services', [])], is_public)
+            if flavor is None:
+                raise Exception("Can't tell which flavor of Mesos the slave runs: found none of " + ", ".join(MESOS_SLAVE_SERVICES))
+            args = self.flavor_args[flavor]
+            service = (self.args.mesos_slave_service_name_public if is_public else self.args.mesos_slave_service_name_private) or service
+        else:
+            flavor = self.args.mesos_flavor
+            args = self.args
+            service = args.mesos_slave_service_name_public if is_public else args.mesos_slave_service_name_private
+        executor_env = sections.get('executor-env-' + str(executor_env_files.index(args.mesos_slave_executor_env_file)), [])
+
+        free_kb = sections.get('free-kb', [])
+        return {
+            'hostname': sections['hostname'][0].strip(),
+            'docker_active': sections.get('docker', [""])[0].strip() == "active",
+            'digests': parse_digests(sections.get('digests', [])),
+            'free_kb': int(free_kb[0]) if len(free_kb) != 0 and free_kb[0].strip().isdigit() else None,
+            'flavor': flavor,
+            'mesos_service': service,
+            'executor_env_file': args.mesos_slave_executor_env_file,
+            'executor_env': None if executor_env == [PROBE_MISSING_MARKER] else "\n".join(executor_env),
+            'router_env_digest': sections['router-env'][0].split()[0] if len(sections.get('router-env', [])) != 0 else None
+        }
+
+
+    def plan_install(self):
+
+        # Go through the whole installation without running anything remotely, as if every slave were new, and
+        # without asking any questions. Each remote operation is recorded in the plan instead.
+        self.plan = Plan()
+        self.skip_warnings = True
+        start = time.time()
+        results = self.install()
+        elapsed = time.time() - start
+
+        self.plan.write(sys.stdout)
+        sys.stderr.write("Planned installation into {0} slaves in {1:.3f}s\n".format(len(results), elapsed))
+        assumed = [slave for slave, facts in sorted(self.facts.items()) if facts.get('flavor_assumed')]
+        if len(assumed) != 0:
+            sys.stderr.write("Planned as running {0} Mesos, since they haven't been probed in the last {1} seconds (use --probe-only first, or --mesos-flavor): {2}\n".format(
+                Installer.PLAN_FLAVOR, self.args.facts_ttl, ", ".join(assumed)
+            ))
+        for result in results:
+            if result.error is not None:
+                sys.stderr.write("Could not plan for " + result.item[0] + ": " + str(result.error) + "\n")
+
+        # A partial plan mustn't pass for a complete one
+        if any(result.error is not None for result in results):
+            sys.exit(1)
+
+
+    def announce_scope_apps(self, results):
+        failed = [result.item[0] for result in results if result.error is not None and result.item[0] in self.weave_scope_apps]
+        announce("Weave Scope app on: " + ", ".join(self.weave_scope_apps) + " (port 4040)")
+        if len(failed) != 0:
+            announce("Weave Scope app not installed on: " + ", ".join(failed) + " (their views of the cluster will be missing until it is)")
+
+
+    def verify_mesh(self, slaves):
+
+        # Every router should come to see every slave installed into as a peer, and its IP address manager should
+        # become ready. Each is timed from when the last router was (re)started, since none can see the whole mesh
+        # before then.
+        if len(slaves) == 0:
+            return
+        started = max(self.router_started.values()) if len(self.router_started) != 0 else time.time()
+        deadline = time.time() + self.args.weave_router_convergence_timeout
+        command = "sudo " + self.weave_bin_dir + "/weave status"
+
+        def read_status(slave):
+            # A router that isn't running has nothing to say
+            lines = []
+            def restart():
+                del lines[:]
+            result = self.call_transport(slave, "verify-mesh", command, output=lines.append, restart=restart)
+            return parse_weave_status(lines) if result == 0 else {}
+
+        def verify(slave):
+            metrics = {'host': slave, 'polls': 0, 'seconds_to_mesh': None, 'seconds_to_ipam': None}
+            while True:
+                status = read_status(slave)
+                now = time.time()
+                metrics['polls'] += 1
+                metrics.update(status)
+                if metrics['seconds_to_mesh'] is None and status.get('peers', 0) >= len(slaves):
+                    metrics['seconds_to_mesh'] = max(0.0, now - started)
+                if metrics['seconds_to_ipam'] is None and status.get('ipam_status') in WEAVE_IPAM_READY_STATUSES:
+                    metrics['seconds_to_ipam'] = max(0.0, now - started)
+                if (metrics['seconds_to_mesh'] is not None and metrics['seconds_to_ipam'] is not None) or now >= deadline:
+                    break
+                time.sleep(Installer.MESH_CHECK_INTERVAL)
+            metrics['converged'] = metrics['seconds_to_mesh'] is not None and metrics['seconds_to_ipam'] is not None
+            log(slave, "Weave router sees {0} of {1} peers over {2} connections, IPAM {3}".format(
+                metrics.get('peers', 0), len(slaves), metrics.get('established', 0), metrics.get('ipam_status', "unknown")
+            ))
+            return metrics
+
+        announce("Verifying the Weave mesh on " + str(len(slaves)) + " slaves")
+        results = run_in_parallel(slaves, verify, max(self.args.parallelism, self.args.probe_parallelism))
+        metrics = []
+        for result in results:
+            if result.error is not None:
+                metrics.append({'host': result.item, 'converged': False, 'error': str(result.error)})
+            else:
+                metrics.append(result.value)
+
+        # Sum it up, with the slaves that stand out, and keep the lot
+        summary = summarize_mesh(metrics)
+        with open(self.args.mesh_report_file, "w") as sink:
+            for record in metrics:
+                sink.write(json.dumps(record, sort_keys=True) + "\n")
+            sink.write(json.dumps({'summary': summary}, sort_keys=True) + "\n")
+        self.mesh_converged = summary['converged'] == summary['slaves']
+
+        def describe(stats):
+            if stats is None:
+                return "never"
+            return "median {0:.1f}s, 90th percentile {1:.1f}s, max {2:.1f}s".format(stats['p50'], stats['p90'], stats['max'])
+        announce("Weave mesh: {0} of {1} routers converged. Whole mesh seen: {2}. IPAM ready: {3}. Connections per router: {4}".format(
+            summary['converged'], summary['slaves'], describe(summary['seconds_to_mesh']), describe(summary['seconds_to_ipam']),
+            "none" if summary['connections'] is None else "{0}-{1} (median {2})".format(summary['connections']['min'], summary['connections']['max'], summary['connections']['p50'])
+        ))
+        for outlier in summary['outliers']:
+            announce("  Outlier: " + outlier['host'] + ": " + ", ".join(outlier['reasons']))
+        announce("Weave mesh report written to: " + self.args.mesh_report_file)
+
+
+    def restart_slaves(self, results):
+
+        # Restart public slaves, then private ones, in batches of no more than the maximum unavailable at once
+        batch_size = self.args.mesos_max_unavailable
+        batches = []
+        for is_public in [True, False]:
+            role_results = [result for result in results if result.item[1] == is_public]
+            batches += [role_results[start:start + batch_size] for start in range(0, len(role_results), batch_size)]
+
+        for index, batch in enumerate(batches):
+            slaves = [result.item[0] for result in batch]
+
+            # Restart the Mesos slaves so they pick up the new configuration (keeping, or first moving, their tasks)
+            if not self.proceed("Are you sure you want to restart Mesos slaves " + ", ".join(slaves) + "?"):
+                self.skip_restarts(batches[index:], "Restart of Mesos slave was declined")
+                return
+
+            # Restart the whole batch at once, and wait for all of it to come back before moving on
+            announce("Restarting Mesos slaves (batch " + str(index + 1) + " of " + str(len(batches)) + "): " + ", ".join(slaves))
+            restarts = run_in_parallel([result.item for result in batch], self.restart_slave_safely, len(batch))
+            for result, restart in zip(batch, restarts):
+                result.error = restart.error
+                result.elapsed += restart.elapsed
+
+            # Don't take any more slaves down if some of these didn't come back
+            if any(restart.error is not None for restart in restarts):
+                self.skip_restarts(batches[index + 1:], "Not restarted, because an earlier batch of restarts failed")
+                return
+
+
+    def skip_restarts(self, batches, reason):
+        for batch in batches:
+            for result in batch:
+                log(result.item[0], reason)
+                result.error = RolloutAborted(reason)
+
+
+    def restart_slave_safely(self, item):
+
+        slave, is_public = item
+        try:
+            self.restart_slave(slave, is_public=is_public)
+        except Exception as e:
+            log(slave, "Restart failed: " + str(e))
+            raise
+
+
+    def restart_slave(self, slave, is_public=False):
+
+        # The Mesos slave service depends on the flavor of Mesos found on the slave
+        service_name = self.facts[slave]['mesos_service']
+
+        # Have the master move the slave's tasks elsewhere first, if we were told to
+        machine = None
+        if self.args.mesos_restart_strategy == Installer.RESTART_DRAIN:
+            machine = self.drain_slave(slave)
+
+        try:
+            # Otherwise, unless told not to, keep its executors running through the restart, so that it recovers them
+            script = RemoteScript()
+            if self.args.mesos_restart_strategy == Installer.RESTART_RECOVER:
+                add_keep_executors_steps(script, service_name)
+            script.add("sudo systemctl daemon-reload && sudo systemctl restart " + service_name)
+            self.run_script(slave, script, step="restart-slave")
+
+            # The slave counts as back once both it and the Weave router (which it now depends on) are active
+            service_names = [service_name]
+            if self.args.weave_with_router:
+                service_names.append("weave-router.service")
+            self.wait_until_active(slave, service_names)
+        finally:
+            if machine is not None:
+                self.end_maintenance(slave, machine)
+        self.journal.record(slave, "restart-slave", digest(json.dumps(self.executor_env_properties(slave), sort_keys=True)))
+
+
+    def drain_slave(self, slave):
+
+        # Find the slave's machine as the master knows it (unless we're just planning, when the master isn't asked)
+        hostname = self.facts[slave]['hostname']
+        machine = {'hostname': hostname}
+        agent = None
+        if self.plan is None:
+            agent = find_mesos_agent(self.call_master(slave, "/slaves"), [slave, hostname])
+            if agent is None:
+                raise Exception("The Mesos master at " + self.args.mesos_master_url + " doesn't know the slave")
+            machine = mesos_machine_id(agent)
+
+        # Schedule maintenance for it, starting now, so that frameworks move its tasks elsewhere
+        log(slave, "Draining tasks from the Mesos slave")
+        now = time.time()
+        with self.maintenance_lock:
+            schedule = self.call_master(slave, "/maintenance/schedule") or {}
+            windows = schedule.get('windows', [])
+            windows.append({
+                'machine_ids': [machine],
+                'unavailability': {
+                    'start': {'nanoseconds': int(now * 1e9)},
+                    'duration': {'nanoseconds': int((self.args.mesos_drain_timeout + self.args.mesos_restart_timeout) * 1e9)}
+                }
+            })
+            self.call_master(slave, "/maintenance/schedule", {'windows': windows})
+
+        # Wait for them to go, then take the machine down for the restart
+        if agent is not None:
+            deadline = now + self.args.mesos_drain_timeout
+            while True:
+                tasks = running_tasks(self.call_master(slave, "/tasks?limit=" + str(Installer.MASTER_TASKS_LIMIT)), agent['id'])
+                if len(tasks) == 0:
+                    log(slave, "Mesos slave drained in {0:.0f}s".format(time.time() - now))
+                    break
+                if time.time() >= deadline:
+                    self.end_maintenance(slave, machine, down=False)
+                    raise Exception(str(len(tasks)) + " tasks still running on the Mesos slave after draining for " + str(self.args.mesos_drain_timeout) + " seconds")
+                time.sleep(Installer.DRAIN_CHECK_INTERVAL)
+        self.call_master(slave, "/machine/down", [machine])
+        return machine
+
+
+    def end_maintenance(self, slave, machine, down=True):
+
+        # Bring the machine back up, and take it out of the maintenance schedule
+        if down:
+            self.call_master(slave, "/machine/up", [machine])
+        with self.maintenance_lock:
+            schedule = self.call_master(slave, "/maintenance/schedule") or {}
+            windows = []
+            for window in schedule.get('windows', []):
+                window['machine_ids'] = [machine_id for machine_id in window['machine_ids'] if machine_id != machine]
+                if len(window['machine_ids']) != 0:
+                    windows.append(window)
+            self.call_master(slave, "/maintenance/schedule", {'windows': windows})
+
+
+    def call_master(self, host, path, data=None, step="drain"):
+
+        # Ask the Mesos master, on behalf of the given slave. Requests with data are POSTs, which change something, so
+        # when planning they're just recorded (and nothing is asked).
+        url = self.args.mesos_master_url.rstrip("/") + path
+        request = ("GET " if data is None else "POST ") + url + ("" if data is None else " " + json.dumps(data, sort_keys=True))
+        if self.plan is not None:
+            if data is not None:
+                self.plan.record(host, step, request)
+            return None
+        if data is not None:
+            log(host, "Asking the Mesos master: " + request, step=step)
+        return mesos_master_request(url, data)
+
+
+    def wait_until_active(self, host, service_names):
+
+        log(host, "Waiting for services to become active: " + " ".join(service_names))
+        deadline = time.time() + self.args.mesos_restart_timeout
+        while True:
+            result = self.call_transport(host, "health-check", "systemctl is-active " + " ".join(service_names), output=lambda line: None)
+            if result == 0:
+                log(host, "Services are active")
+                return
+            if time.time() >= deadline:
+                raise Exception("Services did not become active within " + str(self.args.mesos_restart_timeout) + " seconds: " + " ".join(service_names))
+            time.sleep(Installer.HEALTH_CHECK_INTERVAL)
+
+
+    def distribute_binaries(self, slaves):
+
+        payload = self.executables_payload()
+        degree = self.args.fanout_degree
+
+        # Find out which slaves already have them. Those that do can pass them on straight away.
+        changed_paths = {}
+        def check(slave):
+            changed_paths[slave] = payload.changed_paths(self.facts[slave]['digests'])
+        checked = [result.item for result in run_in_parallel(slaves, check, self.args.parallelism) if result.error is None]
+        sources = [slave for slave in checked if len(changed_paths[slave]) == 0]
+        needing = [slave for slave in checked if len(changed_paths[slave]) != 0]
+        if len(needing) == 0:
+            return
+
+        # Without any such slave, send them to the first few from here
+        if len(sources) == 0:
+            seeds = needing[:degree]
+            needing = needing[degree:]
+            announce("Sending executables to " + str(len(seeds)) + " slaves to seed distribution")
+            results = run_in_parallel(seeds, lambda slave: self.run_script(slave, RemoteScript(), payload=payload, step="seed-executables"), self.args.parallelism)
+            sources = [result.item for result in results if result.error is None]
+            for slave in sources:
+                self.add_distributed_paths(slave, changed_paths[slave], payload)
+
+        # Then have every slave that has them pass them on to a few more, until all have them. The number of slaves
+        # with the executables grows by a factor of (degree + 1) with every wave.
+        wave = 0
+        while len(needing) != 0 and len(sources) != 0:
+            wave += 1
+            relays = []
+            for source in sources:
+                for _ in range(degree):
+                    if len(needing) != 0:
+                        relays.append((source, needing.pop(0)))
+            announce("Relaying executables between slaves, wave " + str(wave) + ": " + str(len(relays)) + " slaves")
+            results = run_in_parallel(relays, lambda relay: self.relay_binaries(relay[0], relay[1], payload.paths()), self.args.parallelism)
+            targets = [result.item[1] for result in results if result.error is None]
+            for slave in targets:
+                self.add_distributed_paths(slave, changed_paths[slave], payload)
+            sources += targets
+
+        # Any slave that still lacks them (because a relay failed) is sent them directly when it is installed
+
+
+    def executables_payload(self):
+        # The executables every slave needs
+        payload = Payload()
+        payload.add(self.weave_bin_dir + "/weave", read_file("./weave"), 0755)
+        if self.args.weave_with_scope:
+            payload.add(self.weave_bin_dir + "/weave-scope", read_file("./weave-scope"), 0755)
+        return payload
 
-        # Install to private Mesos slaves
-        for slave in self.mesos_private_slaves:
-            self.install_into_slave(slave, is_public=False)
 
+    def add_distributed_paths(self, slave, paths, payload):
 
-    def install_into_slave(self, slave, is_public=False):
+        # The services running these executables still need restarting, even if this run is resumed before they are
+        paths = self.distributed_paths.get(slave, set()) | paths
+        self.distributed_paths[slave] = paths
+        self.facts_cache.forget(slave)
 
-        print "------------------------------------------------------------------"
-        print "Installing Weave into Mesos slave: " + slave
+        # The slave has them now, so installing into it mustn't send them again
+        digests = dict(self.facts[slave]['digests'])
+        digests.update((file['path'], file['digest']) for file in payload.files)
+        self.facts[slave]['digests'] = digests
+        self.journal.record(slave, "distribute-executables", payload.fingerprint(), paths=sorted(paths))
 
-        # Make sure target directories exist
-        self.execute_remotely(slave, "sudo install -d " + self.weave_tmp_dir)
-        self.execute_remotely(slave, "sudo install -d " + self.weave_bin_dir)
 
-        # Install Weave executable
-        self.copy_file_local_to_remote(
-            slave,
-            "./weave",
-            self.weave_bin_dir + "/",
-            mode=0755,
-            user="root", group="root"
+    def relay_binaries(self, source, target, paths):
+
+        # Unpack on the target as a payload would be, from an archive streamed straight from the source
+        log(target, "Receiving executables from " + source)
+        target_script = RemoteScript()
+        add_unpack_steps(target_script, paths, archive_root=self.weave_bin_dir)
+        names = [os.path.relpath(path, self.weave_bin_dir) for path in paths]
+        archive_command = "sudo tar -czf - -C " + self.weave_bin_dir + " " + " ".join(names)
+        script = RemoteScript()
+        script.add(
+            archive_command + " | " + self.transport.relay_command(target, target_script.command(report=False)),
+            description=archive_command + " | (unpack on " + target + ")"
         )
+        self.run_script(source, script, step="relay-executables")
+
+
+    def install_into_slave_safely(self, item):
+
+        slave, is_public = item
+        console.host_started(slave)
+        try:
+            result = self.install_into_slave(slave, is_public=is_public)
+        except Exception as e:
+            # Keep the failure with the rest of this slave's output, then let the runner record it
+            log(slave, "Installation failed: " + str(e))
+            console.host_finished(slave, failed=True)
+            raise
+        console.host_finished(slave)
+        return result
+
+
+    def print_summary(self, results):
+
+        # A slave is skipped if it was never started, or if its Mesos slave restart was held back
+        skipped = [result for result in results if not result.started or isinstance(result.error, RolloutAborted)]
+        succeeded = [result for result in results if result.error is None]
+        failed = [result for result in results if result.error is not None and not result in skipped]
+
+        print "=================================================================="
+        print "Rollout summary: {0} succeeded, {1} failed, {2} skipped".format(len(succeeded), len(failed), len(skipped))
+        for result in results:
+            slave, is_public = result.item
+            role = "public" if is_public else "private"
+            if result.error is None:
+                status = "OK"
+                detail = "{0:.1f}s".format(result.elapsed)
+            elif result in skipped:
+                status = "SKIPPED"
+                detail = str(result.error)
+            else:
+                status = "FAILED"
+                detail = "{0:.1f}s: {1}".format(result.elapsed, result.error)
+            print "  {0:8}{1} ({2}) {3}".format(status, slave, role, detail)
 
-        # Define a list to which the install_and_start_service() calls below will add service file names
-        self.service_file_list = ""
 
-        # Install Weave router service
+    def install_into_slave(self, slave, is_public=False):
+
+        log(slave, "------------------------------------------------------------------")
+        log(slave, "Installing Weave into Mesos slave: " + slave)
+        payload, services, router_service = self.build_slave_payload(slave)
+        facts = self.facts[slave]
+
+        # The router's settings for this slave go into the environment file its service reads for the slave's hostname
+        router_environment = None
         if self.args.weave_with_router:
+            router_environment = self.weave_router_environment(slave)
+
+        # Skip installing the files if an earlier run we're resuming installed these very same ones, and nothing has
+        # been distributed since
+        fingerprint = payload.fingerprint()
+        if router_environment is not None:
+            fingerprint = digest(fingerprint + " " + digest(router_environment))
+        if self.journal.completed(slave, "install-files", fingerprint) is not None and not slave in self.distributed_paths:
+            log(slave, "Files and services were installed by the run being resumed")
+        else:
 
-            self.install_and_start_service(slave, "router", substitutions=self.weave_router_substitutions)
+            # The environment file is named after the slave's hostname, and may hold the router's password
+            if router_environment is not None:
+                environment_path = WEAVE_HOST_ENV_FILE.replace("%H", facts['hostname'])
+                payload.add(environment_path, router_environment, 0600, secret=True)
+                router_service[1].append(environment_path)
+
+            # Leave out any file the slave already has, exactly as it is (including any executables distributed earlier)
+            changed_paths = payload.keep_changed(facts['digests'])
+            restart_paths = changed_paths | self.distributed_paths.get(slave, set())
+
+            # A change to just the router's initial peer count (as the cluster grows or shrinks) is written, for when the
+            # router is next started, but isn't worth restarting it for
+            if router_environment is not None and digest(without_init_peer_count(router_environment)) == facts.get('router_env_digest'):
+                restart_paths.discard(environment_path)
+            if len(changed_paths) != 0:
+                self.facts_cache.forget(slave)
+
+            # Put the changed files in place, then apply the services
+            script = RemoteScript()
+            self.add_apply_services_step(script, services, restart_paths)
+            if len(changed_paths) != 0:
+                self.run_script(slave, script, payload=payload, step="install-files")
+            else:
+                log(slave, "All files are up to date")
+                self.run_script(slave, script, step="apply-services")
+            if router_service is not None and any(path in restart_paths for path in router_service[1]):
+                self.router_started[slave] = time.time()
+            self.journal.record(slave, "install-files", fingerprint)
+
+        # Install weave proxy socket into Mesos slave
+        # TODO: See issue: https://github.com/TrentBrown/weave-into-mesos/issues/1
+        executor_env_changed = False
+        entry = None
+        if self.args.weave_with_router:
+            properties = self.executor_env_properties(slave)
+            fingerprint = digest(json.dumps(properties, sort_keys=True))
+            entry = self.journal.completed(slave, "executor-env", fingerprint)
+            if entry is not None:
+                executor_env_changed = entry['changed'] and self.journal.completed(slave, "restart-slave", fingerprint) is None
+                if executor_env_changed:
+                    log(slave, "Mesos slave configuration was updated by the run being resumed, but the slave not yet restarted")
+                else:
+                    log(slave, "Mesos slave configuration was updated (and the slave restarted, if need be) by the run being resumed")
+            else:
+                # Vanilla Mesos slaves only have the file if the flag has been set already. It isn't created here: once
+                # set, the flag is all the environment executors get, and they would lose the slave's (PATH included).
+                executor_env = facts['executor_env']
+                if executor_env is None and facts['flavor'] == Installer.FLAVOR_VANILLA:
+                    raise Exception("Mesos slave executor environment file not found: " + facts['executor_env_file'] + " (create it with the environment the executors need, such as PATH, as a JSON object)")
+                if executor_env is None:
+                    raise Exception("Mesos slave executor environment file not found: " + facts['executor_env_file'])
+                changed_paths = self.add_properties_to_remote_json_files(
+                    slave,
+                    properties,
+                    contents={facts['executor_env_file']: executor_env},
+                    mode=0644,
+                    user="root", group="root",
+                    step="executor-env"
+                )
+                executor_env_changed = len(changed_paths) != 0
+                if executor_env_changed:
+                    self.facts_cache.forget(slave)
+                self.journal.record(slave, "executor-env", fingerprint, changed=executor_env_changed)
+
+        # The Mesos slave only needs a restart if its configuration changed. Restarts happen later, a few slaves at a
+        # time, so that the cluster never loses too much of its capacity at once.
+        if not executor_env_changed and entry is None:
+            log(slave, "Mesos slave configuration is unchanged, so it will not be restarted")
+        return executor_env_changed
+
+
+    def build_slave_payload(self, slave):
+
+        # Every file the slave needs goes into one archive, which is sent and unpacked into place in one go
+        payload = Payload()
 
-            # Install weave proxy socket into Mesos slave
-            # TODO: See issue: https://github.com/TrentBrown/weave-into-mesos/issues/1
-            key = "DOCKER_HOST"
-            value = "unix://" + self.args.weave_proxy_socket
-            self.add_property_to_remote_json_file(
-                slave,
-                self.args.mesos_slave_executor_env_file,
-                key, value,
-                mode=0644,
-                user="root", group="root"
-            )
+        # Install Weave executable
+        weave_path = self.weave_bin_dir + "/weave"
+        payload.add(weave_path, read_file("./weave"), 0755)
 
+        # Collect the service files installed below, with the executables each one runs
+        services = []
+
+        # Install Weave router service
+        router_service = None
+        if self.args.weave_with_router:
+            router_service = self.install_service(payload, "router", [weave_path], substitutions=self.weave_router_substitutions)
+            services.append(router_service)
 
         # Install Weave proxy service
         if self.args.weave_with_proxy:
-            self.install_and_start_service(slave, "proxy", substitutions=self.weave_proxy_substitutions)
+            services.append(self.install_service(payload, "proxy", [weave_path], substitutions=self.weave_proxy_substitutions))
 
         # Install Weave scope service
         if self.args.weave_with_scope:
 
             # Install executable
-            self.copy_file_local_to_remote(
-                slave,
-                "./weave-scope",
-                self.weave_bin_dir + "/",
-                mode=0755,
-                user="root", group="root"
-            )
+            weave_scope_path = self.weave_bin_dir + "/weave-scope"
+            payload.add(weave_scope_path, read_file("./weave-scope"), 0755)
 
-            self.install_and_start_service(slave, "scope", substitutions=self.weave_scope_substitutions)
+            substitutions = self.weave_scope_substitutions[self.weave_scope_role(slave)]
+            services.append(self.install_service(payload, "scope", [weave_path, weave_scope_path], substitutions=substitutions))
 
         # Install Weave service target file
         target_substitutions = []
-        self.append_substitution(target_substitutions, "{{SERVICE_FILE_LIST}}", self.service_file_list)
-        self.copy_file_local_to_remote(
-            slave,
-            "./weave.target",
-            "/etc/systemd/system/",
-            mode=0644,
-            user="root", group="root",
-            substitutions=target_substitutions
-        )
-
-        # Restart the Mesos slave so it picks up the new configuration
-        # TODO: Is there a more graceful way to do this? Currently orphans containers running under Marathon (eg. Chronos).
-        # TODO: This looks relevant: https://issues.apache.org/jira/browse/MESOS-1474
-        if not self.proceed("Are you sure you want to restart Mesos slave " + slave + "?"):
-            exit(0)
-        if is_public:
-            service_name = self.args.mesos_slave_service_name_public
-        else:
-            service_name = self.args.mesos_slave_service_name_private
-        self.execute_remotely(slave, "sudo systemctl daemon-reload")
-        self.execute_remotely(slave, "sudo systemctl stop " + service_name)
-        self.execute_remotely(slave, "sudo systemctl start " + service_name)
+        service_files = [service_file for service_file, _ in services]
+        self.append_substitution(target_substitutions, "{{SERVICE_FILE_LIST}}", ' '.join(service_files))
+        payload.add("/etc/systemd/system/weave.target", render_file("./weave.target", target_substitutions), 0644)
 
+        return payload, services, router_service
 
-    def install_and_start_service(self, slave, name, substitutions=None):
+
+    def executor_env_properties(self, slave):
+        # The properties the Mesos slave's executor environment file needs, to use the Weave proxy
+        return {self.facts[slave]['executor_env_file']: {"DOCKER_HOST": "unix://" + self.args.weave_proxy_socket}}
+
+
+    def add_apply_services_step(self, script, services, restart_paths):
+
+        # Restart only the services whose files changed, all in one go so systemd orders them by their dependencies. The
+        # others are just started, which leaves a running service alone (and so doesn't disturb the Weave network).
+        restarts = [service_file for service_file, paths in services if any(path in restart_paths for path in paths)]
+        starts = [service_file for service_file, paths in services if not service_file in restarts]
+        commands = []
+        if any(path.startswith("/etc/systemd/") for path in restart_paths):
+            commands.append("sudo systemctl daemon-reload")
+        if len(services) != 0:
+            commands.append("sudo systemctl enable " + " ".join(service_file for service_file, _ in services))
+        if len(restarts) != 0:
+            commands.append("sudo systemctl restart " + " ".join(restarts))
+        if len(starts) != 0:
+            commands.append("sudo systemctl start " + " ".join(starts))
+        if len(commands) != 0:
+            script.add(" && ".join(commands))
+
+
+    def install_service(self, payload, name, executable_paths, substitutions=None):
 
         service_filename = "weave-" + name + ".service"
+        service_file_path = "/etc/systemd/system/" + service_filename
 
         # Install service file
-        self.copy_file_local_to_remote(
-            slave,
-            "./" + service_filename,
-            "/etc/systemd/system/",
-            mode=0644,
-            user="root", group="root",
-            substitutions=substitutions
-        )
+        payload.add(service_file_path, render_file("./" + service_filename, substitutions), 0644)
 
-        # Enable service, so it will start at boot
-        self.execute_remotely(slave, "sudo systemctl enable " + service_filename)
+        # The service needs a restart if its service file, or any executable it runs (or other file it reads), changes
+        return service_filename, [service_file_path] + executable_paths
 
-        # Start (or restart) Weave services
-        self.execute_remotely(slave, "sudo systemctl stop {0} || echo {0} not running".format(service_filename))
-        self.execute_remotely(slave, "sudo systemctl start " + service_filename)
 
-        # Append to the service file list
-        if len(self.service_file_list) != 0:
-            self.service_file_list += " "
-        self.service_file_list += service_filename
+    # Helpers -----------------------------------------------
 
+    def call_transport(self, host, step, command, payload=None, script=None, output=None, stdout=None, restart=None):
+
+        # When planning, just record the operation, as if it succeeded without output
+        if self.plan is not None:
+            self.plan.record(host, step, command, payload=payload, script=script)
+            return 0
+
+        # Every remote operation goes through here. If the slave couldn't be reached, the operation is tried again
+        # after a while (unless that isn't safe), discarding its output so far (with the given 'restart' function).
+        input = None
+        if payload is not None:
+            input = payload.archive()
+        if output is None:
+            output = lambda line: log(host, line)
+        attempts = 1 if step in Installer.UNRETRIED_STEPS else self.args.retries + 1
+        for attempt in range(1, attempts + 1):
+            self.circuit_breaker.check(host)
+            if attempt > 1:
+                delay = retry_delay(self.args.retry_backoff, attempt - 1, Installer.RETRY_BACKOFF_MAX)
+                log(host, "Trying again in {0:.1f}s (attempt {1} of {2})".format(delay, attempt, attempts), step=step)
+                time.sleep(delay)
+                if restart is not None:
+                    restart()
+                if stdout is not None:
+                    stdout.seek(0)
+                    stdout.truncate()
+
+            result, unreachable = self.attempt_transport(host, step, command, input, script, output, stdout, attempt)
+            if not unreachable:
+                self.circuit_breaker.succeeded(host)
+                return result
+
+            # Stop trying a slave that can't be reached again and again
+            if result == TIMEOUT_EXIT_CODE:
+                log(host, "Remote operation timed out after " + str(self.args.operation_timeout) + " seconds", step=step)
+            if self.circuit_breaker.failed(host):
+                log(host, "Quarantined for the rest of the run, after failing to be reached " + str(self.args.circuit_breaker_threshold) + " times in a row", step=step)
+                self.circuit_breaker.check(host)
+
+        if result == TIMEOUT_EXIT_CODE:
+            raise Exception("Remote operation timed out after " + str(self.args.operation_timeout) + " seconds")
+        return result
+
+
+    def attempt_transport(self, host, step, command, input, script, output, stdout, attempt):
+
+        # Time and record the operation under the given step name, noting whether any step of the script failed (in
+        # which case the slave was clearly reached, whatever the exit code)
+        received = [0]
+        step_failed = [False]
+        def counting_output(line):
+            received[0] += len(line) + 1
+            if script is not None:
+                status = script.parse_status(line)[1]
+                if status is not None and status[1] != 0:
+                    step_failed[0] = True
+            output(line)
+
+        start = time.time()
+        logging_context.step = step
+        try:
+            result = self.transport.execute(host, command, input=input, output=counting_output, stdout=stdout, timeout=self.args.operation_timeout or None)
+        finally:
+            logging_context.step = None
+        end = time.time()
+
+        if stdout is not None:
+            received[0] += stdout.tell()
+        self.report.record(
+            host=host, step=step, start=start, end=end,
+            bytes_sent=len(command) + (len(input) if input is not None else 0),
+            bytes_received=received[0],
+            exit_code=result,
+            attempt=attempt
+        )
+        return result, result in [UNREACHABLE_EXIT_CODE, TIMEOUT_EXIT_CODE] and not step_failed[0]
 
-    # Helpers -----------------------------------------------
 
-    def execute_remotely(self, host, command):
+    def read_remotely(self, host, command, step="read"):
 
         # Print description
-        description = "Executing remotely: " + command
-        print description
-
-        # Execute command with "ssh"
-        admin_at_host = self.args.mesos_admin_username + "@" + host
-        result = call(["ssh", admin_at_host, command])
+        description = "Reading remotely: " + command
+        log(host, description, step=step)
+
+        # Execute command over the transport, keeping its output
+        lines = []
+        def restart():
+            del lines[:]
+        result = self.call_transport(host, step, command, output=lines.append, restart=restart)
         if result is not 0:
             raise Exception("Remote execution failed with code: " + str(result))
+        return lines
 
 
-    def copy_file_remote_to_local(self, host, remote_file_path, local_path, **kwargs):
+    def run_script(self, host, script, payload=None, step="script"):
 
-        # Build local file path
-        file_name = os.path.basename(remote_file_path)
-        if local_path.endswith("/"):
-            local_file_path = local_path + file_name
-        else:
-            local_file_path = local_path
+        # If there are files to install, unpack them into place before anything else, with the archive as input
+        if payload is not None:
+            log(host, "Sending one archive of " + str(len(payload.files)) + " files: " + ", ".join(payload.paths()), step=step)
+            batch = RemoteScript()
+            payload.add_install_steps(batch)
+            batch.extend(script)
+            script = batch
 
         # Print description
-        description = "Copying remote file to local: " + remote_file_path + " ---> " + local_file_path
-        print description
+        description = "Executing remotely as one batch: " + str(len(script.steps)) + " steps"
+        log(host, description, step=step)
+
+        # Report (and record) each step as the script finishes it, and pass any other output through
+        statuses = {}
+        finished = [time.time()]
+        def output(line):
+            prefix, status = script.parse_status(line)
+            if prefix != "":
+                log(host, prefix)
+            if status is not None:
+                index, code = status
+                statuses[index] = code
+                log(host, "  [" + ("ok" if code == 0 else "exit " + str(code)) + "] " + script.descriptions[index])
+                now = time.time()
+                self.report.record(host=host, step=step, start=finished[0], end=now, exit_code=code, script_step=script.descriptions[index])
+                finished[0] = now
+
+        # Execute the script over the transport
+        result = self.call_transport(host, step, script.command(), payload=payload, script=script, output=output)
+        if result is not 0:
+            failed = [index for index in statuses if statuses[index] != 0]
+            if len(failed) != 0:
+                raise Exception("Remote step failed with code: " + str(statuses[failed[0]]) + ": " + script.descriptions[failed[0]])
+            raise Exception("Remote execution failed with code: " + str(result))
 
-        # Make a copy of the remote file on the remote machine (because scp alone can't get sudoer access to it)
-        remote_tmp_file_path = self.weave_tmp_dir + "/" + file_name
-        self.execute_remotely(host, "sudo cp -f " + remote_file_path + " " + remote_tmp_file_path)
 
-        # Copy the file with "scp"
-        user_at_host = self.args.mesos_admin_username + "@" + host + ":"
-        result = call(["scp", user_at_host + remote_tmp_file_path, local_file_path])
-        if result is not 0:
-            raise Exception("Copying file from remote failed with code: " + str(result))
-
-        # Set mode of local file, if provided
-        if 'mode' in kwargs:
-            mode = kwargs['mode']
-            os.chmod(local_file_path, mode)
-
-        # Set ownership of local file, if provided
-        uid = -1
-        gid = -1
-        if 'user' in kwargs:
-            user = kwargs['user']
-            uid = pwd.getpwnam(user).pw_uid
-        if 'group' in kwargs:
-            group = kwargs['group']
-            gid = grp.getgrnam(group).gr_gid
-        if uid != -1 or gid != -1:
-            os.chown(local_file_path, uid, gid)
-
-        # Clean up
-        self.execute_remotely(host, "rm -f " + remote_tmp_file_path)
-
-
-    def copy_file_local_to_remote(self, host, local_file_path, remote_path, **kwargs):
-        
-        # Build remote file path
-        file_name = os.path.basename(local_file_path)
-        if remote_path.endswith("/"):
-            remote_file_path = remote_path + file_name
+    def add_properties_to_remote_json_files(self, host, properties_by_path, contents=None, **kwargs):
+
+        # Read all the remote JSON files at once, straight into memory (an empty file has no properties yet), unless
+        # we were given what's in them already
+        paths = sorted(properties_by_path)
+        step = kwargs.get('step', "json-files")
+        if contents is not None:
+            contents = [contents[path] for path in paths]
         else:
-            remote_file_path = remote_path
+            contents = self.read_remote_files(host, paths, step="read-" + step)
+
+        # Add the given properties to each file's JSON, where they're not already there
+        payload = Payload()
+        for path, content in zip(paths, contents):
+            properties = json.loads(content) if content.strip() != "" else {}
+            added = dict((key, value) for key, value in properties_by_path[path].items() if not key in properties)
+            if len(added) == 0:
+                continue
+            log(host, "Adding to remote JSON file " + path + ": " + ", ".join(sorted(added)))
+            properties.update(added)
+            payload.add(
+                path,
+                json.dumps(properties),
+                kwargs.get('mode', 0644),
+                user=kwargs.get('user', "root"), group=kwargs.get('group', "root")
+            )
 
-        # Print description
-        description = "Copying local file to remote: " + local_file_path + " ---> " + remote_file_path
-        print description
-        
-        # Do substitutions, if specified, in a local copy of the file
-        do_substitute = 'substitutions' in kwargs
-        substituted_file_path = self.args.local_tmp_dir + "/" + file_name
-        if do_substitute:
-            substitutions = kwargs['substitutions']
-            local_file_path = substitute(local_file_path, substitutions, substituted_file_path)
-
-        # Copy the file with "scp" to a remote temporary file (because scp alone can't get sudoer access)
-        remote_tmp_file_path = self.weave_tmp_dir + "/" + file_name
-        user_at_host = self.args.mesos_admin_username + "@" + host + ":"
-        result = call(["scp", local_file_path, user_at_host + remote_tmp_file_path])
-        if result is not 0:
-            raise Exception("Copying file to remote failed with code: " + str(result))
+        # Replace all the changed files at once, each atomically
+        if len(payload.files) != 0:
+            self.run_script(host, RemoteScript(), payload=payload, step="write-" + step)
+        return set(payload.paths())
 
-        # Copy the remote temporary file into place with sudoer access
-        self.execute_remotely(host, "sudo cp -f " + remote_tmp_file_path + " " + remote_file_path)
 
-        # Set mode of remote file, if provided
-        if 'mode' in kwargs:
-            mode = kwargs['mode']
-            self.execute_remotely(host, "sudo chmod " + oct(mode) + " " + remote_file_path)
+    def read_remote_files(self, host, paths, step="read-files"):
 
-        # Set ownership of remote file, if provided
-        ownership = ""
-        if 'user' in kwargs:
-            user = kwargs['user']
-            ownership += user
-        if 'group' in kwargs:
-            group = kwargs['group']
-            ownership += ":" + group
-        if ownership != "":
-            self.execute_remotely(host, "sudo chown " + ownership + " " + remote_file_path)
+        # Print each file (using sudo, so that any file can be read) after a marker line with its index, and split the
+        # output back up on those markers
+        command = " && ".join(
+            "echo " + REMOTE_FILE_MARKER + " " + str(index) + " && sudo cat " + pipes.quote(path) + " && echo"
+            for index, path in enumerate(paths)
+        )
+        contents = [[] for path in paths]
+        current = None
+        for line in self.read_remotely(host, command, step=step):
+            if line.startswith(REMOTE_FILE_MARKER + " "):
+                current = contents[int(line.split()[1])]
+            elif current is not None:
+                current.append(line)
+        return ["\n".join(lines) for lines in contents]
 
-        # Clean up
-        self.execute_remotely(host, "rm -f " + remote_tmp_file_path)
-        if do_substitute:
-            os.remove(substituted_file_path)
 
+    def proceed(self, warning):
 
-    def add_property_to_remote_json_file(self, host, remote_file_path, key, value, **kwargs):
+        # Always proceed if we were told to skip all warnings
+        if self.skip_warnings:
+            return True
 
-        # Get a local copy of the remote JSON file
-        file_name = os.path.basename(remote_file_path)
-        local_file_path = self.args.local_tmp_dir + "/" + file_name
-        self.copy_file_remote_to_local(host, remote_file_path, local_file_path)
+        # Proceed only if the user says we should after we warn them, once they've seen everything before the warning
+        console.flush()
+        with self.proceed_lock, output_lock:
+            sys.stdout.write('%s [y/n]\n' % warning)
+            while True:
+                try:
+                    return strtobool(raw_input().lower())
+                except ValueError:
+                    sys.stdout.write('Please respond with \'y\' or \'n\'.\n')
 
-        # Load JSON from local file
-        with open(local_file_path, "r") as source:
-            properties = json.load(source)
 
-        # Add the given property to the JSON, if it's not already there
-        if not key in properties:
-            properties[key] = value
+# Printed before each file by the command that reads several remote files at once
+REMOTE_FILE_MARKER = "@@WIM-FILE"
 
-        # Save JSON back to local file
-        with open(local_file_path, "w") as sink:
-            json.dump(properties, sink)
+# Printed before each fact by the command that probes a slave, and in place of a file that doesn't exist
+PROBE_MARKER = "@@WIM-FACT"
+PROBE_MISSING_MARKER = "@@WIM-MISSING"
 
-        # Replace the remote JSON file with the local one
-        self.copy_file_local_to_remote(host, local_file_path, remote_file_path, **kwargs)
 
-        # Clean up
-        os.remove(local_file_path)
+class RolloutAborted(Exception):
+    """Raised to stop a rollout from starting on any more slaves."""
+    pass
 
 
-    def proceed(self, warning):
+class HostQuarantined(Exception):
+    """Raised instead of trying anything more on a slave that kept failing to be reached."""
+    pass
 
-        # Always proceed if we were told to skip all warnings
-        if self.skip_warnings:
+
+class TaskResult:
+
+    def __init__(self, item):
+        self.item = item
+        self.started = False
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+
+
+def run_in_parallel(items, function, parallelism):
+
+    # Queue up the work, remembering the original order for the results
+    results = [TaskResult(item) for item in items]
+    work = Queue.Queue()
+    for result in results:
+        work.put(result)
+    aborted = threading.Event()
+
+    def worker():
+        while True:
+            try:
+                result = work.get_nowait()
+            except Queue.Empty:
+                return
+
+            # Don't start anything new once the rollout has been aborted
+            if aborted.is_set():
+                result.error = RolloutAborted("Not started because the rollout was aborted")
+                continue
+
+            result.started = True
+            start = time.time()
+            try:
+                result.value = function(result.item)
+            except RolloutAborted as e:
+                aborted.set()
+                result.error = e
+            except Exception as e:
+                result.error = e
+            result.elapsed = time.time() - start
+
+    # Run the workers. A single worker needs no thread of its own.
+    worker_count = max(1, min(parallelism, len(items)))
+    if worker_count == 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker) for _ in range(worker_count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # Join with a timeout, so that Ctrl-C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return results
+
+
+class RunReport:
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+
+    def record(self, **fields):
+
+        # A record is either a whole remote operation, or (with 'script_step') one step of a script, timed by when the
+        # script reported it finished
+        fields['duration'] = fields['end'] - fields['start']
+        with self.lock:
+            self.records.append(fields)
+
+
+    def write(self, file_path):
+        with open(file_path, "w") as sink:
+            for record in self.records:
+                sink.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+    def print_summary(self, count=5):
+
+        # Only whole operations count towards the totals; script steps are already part of them
+        operations = [record for record in self.records if not 'script_step' in record]
+        if len(operations) == 0:
+            return
+
+        print "------------------------------------------------------------------"
+        print "Slowest slaves (total time in remote operations):"
+        print "  {0:>9} {1:>6} {2:>12}  {3}".format("seconds", "ops", "bytes", "slave")
+        for host, records in self.slowest(operations, 'host', count):
+            print "  {0:>9.2f} {1:>6} {2:>12}  {3}".format(
+                sum(record['duration'] for record in records),
+                len(records),
+                sum(record['bytes_sent'] + record['bytes_received'] for record in records),
+                host
+            )
+
+        print "Slowest steps (total time across all slaves):"
+        print "  {0:>9} {1:>6} {2:>9} {3:>9}  {4}".format("seconds", "ops", "mean", "max", "step")
+        for step, records in self.slowest(operations, 'step', count):
+            durations = [record['duration'] for record in records]
+            print "  {0:>9.2f} {1:>6} {2:>9.2f} {3:>9.2f}  {4}".format(sum(durations), len(durations), sum(durations) / len(durations), max(durations), step)
+
+
+    def slowest(self, records, key, count):
+
+        # Group the records by the given key, and return the groups that took the longest in total
+        groups = {}
+        for record in records:
+            groups.setdefault(record[key], []).append(record)
+        ordered = sorted(groups.items(), key=lambda group: -sum(record['duration'] for record in group[1]))
+        return ordered[:count]
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold):
+
+        # How many times in a row each slave has failed to be reached, and which slaves have been given up on
+        self.threshold = threshold
+        self.failures = {}
+        self.quarantined = set()
+        self.lock = threading.Lock()
+
+
+    def check(self, host):
+        with self.lock:
+            if host in self.quarantined:
+                raise HostQuarantined("Quarantined after failing to be reached " + str(self.threshold) + " times in a row")
+
+
+    def succeeded(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+
+
+    def failed(self, host):
+
+        # Returns whether the slave has just been quarantined
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.threshold == 0 or self.failures[host] < self.threshold or host in self.quarantined:
+                return False
+            self.quarantined.add(host)
             return True
 
-        # Proceed only if the user says we should after we warn them
-        sys.stdout.write('%s [y/n]\n' % warning)
+
+def retry_delay(backoff, retry, maximum):
+    # Twice as long before each retry, give or take a random half, so that slaves failing together aren't retried together
+    return min(backoff * 2 ** (retry - 1), maximum) * random.uniform(0.5, 1.5)
+
+
+class ConcurrencyBudget:
+
+    def __init__(self, total):
+
+        # How many units of work may be in progress at once, across everything sharing the budget
+        self.available = total
+        self.condition = threading.Condition()
+
+
+    def acquire(self, amount):
+        with self.condition:
+            while self.available < amount:
+                self.condition.wait()
+            self.available -= amount
+
+
+    def release(self, amount):
+        with self.condition:
+            self.available += amount
+            self.condition.notify_all()
+
+
+class FactsCache:
+
+    def __init__(self, file_path, ttl):
+
+        # What was found out about each slave, and when, as long as that was recently enough
+        self.file_path = file_path
+        self.ttl = ttl
+        self.facts = {}
+        self.lock = threading.Lock()
+        if ttl > 0:
+            self.facts = load_private_json(file_path, {})
+
+
+    def get(self, host, inputs):
+        # The facts found out about the host recently, by a probe with the same inputs
+        with self.lock:
+            facts = self.facts.get(host)
+        if facts is None or not 0 <= time.time() - facts['time'] < self.ttl or facts.get('inputs') != inputs:
+            return None
+        return facts
+
+
+    def put(self, host, facts, inputs):
+        facts['time'] = time.time()
+        facts['inputs'] = inputs
+        with self.lock:
+            self.facts[host] = facts
+
+
+    def forget(self, host):
+        # What was found out about a slave no longer holds once it's been changed
+        with self.lock:
+            self.facts.pop(host, None)
+
+
+    def save(self):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            save_private_json(self.file_path, self.facts)
+
+
+class Journal:
+
+    def __init__(self, file_path=None, resume=False):
+
+        # The last record of each (slave, step) completed by the run being resumed. Steps completed by this run are
+        # only written to the file, which is flushed after each one, so that it survives the installer being killed.
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.sink = None
+        if file_path is None:
+            return
+        complete = True
+        if resume and os.path.exists(file_path):
+            with open(file_path, "r") as source:
+                for sequence, line in enumerate(source):
+                    complete = line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be cut short by a crash
+                        continue
+                    entry['sequence'] = sequence
+                    self.entries[(entry['host'], entry['step'])] = entry
+        self.sink = open(file_path, "a" if resume else "w")
+        if not complete:
+            self.sink.write("\n")
+
+
+    def completed(self, host, step, fingerprint=None):
+        # The record of the given step on the given slave, if it was completed (with the same content, if given)
+        entry = self.entries.get((host, step))
+        if entry is None or (fingerprint is not None and entry['fingerprint'] != fingerprint):
+            return None
+        return entry
+
+
+    def record(self, host, step, fingerprint, **data):
+        if self.sink is None:
+            return
+        data.update(host=host, step=step, fingerprint=fingerprint, time=time.time())
+        with self.lock:
+            self.sink.write(json.dumps(data, sort_keys=True) + "\n")
+            self.sink.flush()
+
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+
+
+class Plan:
+
+    def __init__(self):
+        # The operations for each slave, in the order they would run, and the content of every file they would send
+        # (keyed by digest, since most files are the same on every slave)
+        self.hosts = {}
+        self.files = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, host, step, command, payload=None, script=None):
+
+        operation = {'step': step, 'command': command}
+        if script is not None:
+            operation['steps'] = list(script.steps)
+        if payload is not None:
+            operation['files'] = []
+            for file in payload.files:
+                operation['files'].append({
+                    'path': file['path'], 'mode': oct(file['mode']), 'user': file['user'], 'group': file['group'], 'sha256': file['digest']
+                })
+
+        with self.lock:
+            self.hosts.setdefault(host, []).append(operation)
+            if payload is not None:
+                for file in payload.files:
+                    if not file['digest'] in self.files:
+                        self.files[file['digest']] = {'size': len(file['content']), 'secret': True} if file['secret'] else describe_content(file['content'])
+
+
+    def write(self, sink):
+
+        # One operation (or file) per line, so that plans diff well, without paying for json's pretty-printer
+        def entries(items, render):
+            return ",\n".join(render(item) for item in items)
+        sink.write('{\n "files": {\n')
+        sink.write(entries(sorted(self.files.items()), lambda (key, content): "  " + json.dumps(key) + ": " + json.dumps(content)))
+        sink.write('\n },\n "hosts": {\n')
+        sink.write(entries(sorted(self.hosts.items()), lambda (host, operations): "  " + json.dumps(host) + ": [\n" + entries(
+            operations, lambda operation: "   " + dumps_sorted(operation)
+        ) + "\n  ]"))
+        sink.write('\n }\n}\n')
+
+
+def dumps_sorted(value):
+    # The same as json.dumps(value, sort_keys=True), but with json's fast encoder doing all but the dictionaries, since
+    # it can't sort their keys (and strings, the bulk of a plan, going straight to its string encoder)
+    if isinstance(value, basestring):
+        return json.encoder.encode_basestring_ascii(value)
+    if isinstance(value, dict):
+        return "{" + ", ".join(json.encoder.encode_basestring_ascii(key) + ": " + dumps_sorted(value[key]) for key in sorted(value)) + "}"
+    if isinstance(value, list) and any(isinstance(item, dict) for item in value):
+        return "[" + ", ".join(dumps_sorted(item) for item in value) + "]"
+    return json.dumps(value)
+
+
+def describe_content(content):
+    # Text is shown as it is; anything else just by its size
+    if not "\0" in content:
+        try:
+            return content.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    return {'size': len(content)}
+
+
+# Serializes writes to the console across slave threads
+output_lock = threading.Lock()
+
+# Whether log() and announce() write anything at all
+logging_enabled = True
+
+# The step of the installation each thread is running, to label its output with
+logging_context = threading.local()
+
+
+def set_logging(enabled):
+    global logging_enabled
+    logging_enabled = enabled
+
+
+def announce(message):
+    if not logging_enabled:
+        return
+    console.announce(message)
+
+
+def log(host, message, step=None):
+    if not logging_enabled:
+        return
+    if step is None:
+        step = getattr(logging_context, 'step', None)
+    console.log(host, step, message)
+
+
+class Console:
+
+    # Console modes
+    MODE_LINES = "lines"
+    MODE_PROGRESS = "progress"
+
+    # How many lines can wait for a slow console before more are left off it (they still go to the log files)
+    QUEUE_SIZE = 10000
+
+    # Seconds between updates of the progress view
+    PROGRESS_INTERVAL = 2
+
+    # The most log files kept open at once (the rest are reopened when written to), so that thousands of slaves don't
+    # run out of file descriptors
+    OPEN_LOG_FILES = 64
+
+    # Queued to have the console's thread finish
+    STOP = object()
+
+    def __init__(self):
+        # Until started, everything is written straight to the console
+        self.queue = None
+        self.writer = None
+        self.mode = Console.MODE_LINES
+        self.log_dir = None
+        self.log_files = collections.OrderedDict()
+        self.logged_hosts = set()
+        self.log_files_lock = threading.Lock()
+        self.dropped = 0
+
+        # Progress through the slaves, for the progress view
+        self.total = 0
+        self.running = set()
+        self.finished = 0
+        self.failed = 0
+        self.progress_lock = threading.Lock()
+
+
+    def start(self, log_dir, mode, append=False):
+
+        # Log each slave's output in full to its own file, and the console from a thread of its own, so that a slow
+        # console never holds up the slaves
+        self.log_dir = log_dir
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.log_file_mode = "a" if append else "w"
+        self.logged_hosts = set()
+        self.mode = mode
+        self.queue = Queue.Queue(Console.QUEUE_SIZE)
+        self.writer = threading.Thread(target=self.write_queued, args=(self.queue,))
+        self.writer.daemon = True
+        self.writer.start()
+
+
+    def log(self, host, step, message):
+
+        # The log file gets every line, labelled with when it was written
+        label = host if step is None else host + " " + step
+        if self.log_dir is not None:
+            with self.log_files_lock:
+                self.log_file(host).write(time.strftime("%H:%M:%S ") + "[" + label + "] " + message + "\n")
+
+        # The console only gets what it has room for
+        if self.mode == Console.MODE_LINES:
+            self.write("[" + label + "] " + message, block=False)
+
+
+    def log_file(self, host):
+
+        # The host's log file, opened if need be (closing the one least recently written to, if too many are open), and
+        # only started afresh the first time in a run. Called with the log files' lock held.
+        log_file = self.log_files.pop(host, None)
+        if log_file is None:
+            if len(self.log_files) >= Console.OPEN_LOG_FILES:
+                self.log_files.popitem(last=False)[1].close()
+            mode = "a" if host in self.logged_hosts else self.log_file_mode
+            log_file = open(self.log_dir + "/" + host + ".log", mode)
+            self.logged_hosts.add(host)
+        self.log_files[host] = log_file
+        return log_file
+
+
+    def announce(self, message):
+        self.write(message, block=True)
+
+
+    def write(self, text, block=True):
+        if self.queue is None:
+            with output_lock:
+                sys.stdout.write(text + "\n")
+                sys.stdout.flush()
+            return
+        try:
+            self.queue.put(text, block)
+        except Queue.Full:
+            with self.progress_lock:
+                self.dropped += 1
+
+
+    def write_queued(self, queue):
+
+        shown_progress = None
         while True:
             try:
-                return strtobool(raw_input().lower())
-            except ValueError:
-                sys.stdout.write('Please respond with \'y\' or \'n\'.\n')
+                text = queue.get(timeout=Console.PROGRESS_INTERVAL)
+            except Queue.Empty:
+                text = None
+
+            # Say how many lines were left off, once there's room again
+            with self.progress_lock:
+                dropped = self.dropped
+                self.dropped = 0
+                progress = self.progress()
+            with output_lock:
+                if dropped != 0:
+                    sys.stdout.write("(" + str(dropped) + " lines left off the console; see the logs in " + self.log_dir + ")\n")
+                if text is not None and text is not Console.STOP:
+                    sys.stdout.write(text + "\n")
+                if self.mode == Console.MODE_PROGRESS and self.total != 0 and progress != shown_progress:
+                    sys.stdout.write(progress + "\n")
+                    shown_progress = progress
+                sys.stdout.flush()
+            if text is Console.STOP:
+                return
+            if text is not None:
+                queue.task_done()
+
+
+    def progress(self):
+        return "Progress: {0} of {1} slaves installed, {2} failed, {3} in progress{4}".format(
+            self.finished - self.failed, self.total, self.failed, len(self.running),
+            "" if len(self.running) == 0 else " (" + ", ".join(sorted(self.running)[:5]) + ("..." if len(self.running) > 5 else "") + ")"
+        )
+
+
+    def set_total(self, total):
+        with self.progress_lock:
+            self.total = total
+
+
+    def host_started(self, host):
+        with self.progress_lock:
+            self.running.add(host)
+
+
+    def host_finished(self, host, failed=False):
+        with self.progress_lock:
+            self.running.discard(host)
+            self.finished += 1
+            if failed:
+                self.failed += 1
+
+
+    def flush(self):
+        # Wait for everything queued so far to reach the console, such as before asking a question
+        if self.queue is not None:
+            self.queue.join()
+        with self.log_files_lock:
+            for log_file in self.log_files.values():
+                log_file.flush()
+
+
+    def stop(self):
+        self.flush()
+        if self.queue is not None:
+            self.queue.put(Console.STOP)
+            self.writer.join()
+            self.queue = None
+        with self.log_files_lock:
+            for log_file in self.log_files.values():
+                log_file.close()
+            self.log_files = collections.OrderedDict()
+
+
+# Everything written for the user goes through here
+console = Console()
+
+
+def call_logged(host, command, input=None, output=None, stdout=None, timeout=None, kill_group=False, **kwargs):
+
+    # Run the command, passing each line of its output to the given function, or else the log for the given host. A
+    # command that takes longer than any timeout is killed. Only if told to kill its group as well is it run in a
+    # session of its own, which takes it away from the terminal, where ssh asks about host keys and passphrases.
+    if output is None:
+        output = lambda line: log(host, line)
+    if timeout is not None and kill_group:
+        kwargs['preexec_fn'] = os.setsid
+    if stdout is None:
+        process = Popen(command, stdin=(PIPE if input is not None else None), stdout=PIPE, stderr=STDOUT, **kwargs)
+        lines = process.stdout
+    else:
+        process = Popen(command, stdin=(PIPE if input is not None else None), stdout=stdout, stderr=PIPE, **kwargs)
+        lines = process.stderr
+    timer = None
+    timed_out = threading.Event()
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill_process, args=(process, timed_out, kill_group))
+        timer.daemon = True
+        timer.start()
+
+    # Feed any input from another thread, so that neither side of the pipe can block the other
+    if input is not None:
+        writer = threading.Thread(target=write_and_close, args=(process.stdin, input))
+        writer.daemon = True
+        writer.start()
+
+    try:
+        for line in iter(lines.readline, ""):
+            output(line.rstrip("\n"))
+        result = process.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if timed_out.is_set():
+        return TIMEOUT_EXIT_CODE
+    return result
+
+
+def kill_process(process, killed, group=False):
+    killed.set()
+    try:
+        if group:
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        # It finished just in time
+        pass
+
+
+def write_and_close(sink, data):
+    try:
+        sink.write(data)
+    except IOError:
+        # The command exited without reading all of its input; its exit code tells the story
+        pass
+    finally:
+        try:
+            sink.close()
+        except IOError:
+            pass
+
+
+class RemoteScript:
+
+    # Printed by the script after each step, followed by the index of the step and its exit status
+    STATUS_MARKER = "@@WIM-STEP"
+
+    def __init__(self):
+        self.steps = []
+        self.descriptions = []
+        self.setups = []
+        self.cleanups = []
+
+
+    def add(self, command, description=None):
+        # The description, if given, is shown in place of the command
+        self.steps.append(command)
+        self.descriptions.append(description or command)
+
+
+    def add_setup(self, command):
+        # Setups run before the steps, in the script's own shell, so that the variables they set are seen by every step
+        # and cleanup
+        self.setups.append(command)
+
+
+    def add_cleanup(self, command):
+        # Cleanups run when the script exits, whether or not its steps succeeded
+        self.cleanups.append(command)
+
+
+    def extend(self, script):
+        self.steps += script.steps
+        self.descriptions += script.descriptions
+        self.setups += script.setups
+        self.cleanups += script.cleanups
+
+
+    def render(self, report=True):
+
+        lines = []
+        if len(self.cleanups) != 0:
+            lines.append("trap " + pipes.quote("; ".join(self.cleanups)) + " EXIT")
+        for command in self.setups:
+            lines.append(command + " || exit $?")
+
+        # Run each step in a subshell, report its exit status (unless told not to), and stop at the first one that fails
+        for index, command in enumerate(self.steps):
+            lines.append("(")
+            lines.append(command)
+            lines.append(")")
+            if report:
+                lines.append("status=$?; echo; echo {0} {1} $status; [ $status -eq 0 ] || exit $status".format(RemoteScript.STATUS_MARKER, index))
+            else:
+                lines.append("status=$?; [ $status -eq 0 ] || exit $status")
+        return "\n".join(lines) + "\n"
+
+
+    def command(self, report=True):
+        return "sh -c " + pipes.quote(self.render(report))
+
+
+    def parse_status(self, line):
+
+        # Split a line of output into any ordinary output, and the (index, exit status) of a finished step, if any
+        position = line.find(RemoteScript.STATUS_MARKER + " ")
+        if position == -1:
+            return line, None
+        fields = line[position:].split()
+        return line[:position], (int(fields[1]), int(fields[2]))
+
+
+class Payload:
+
+    # Staging directories are created under here on the slave, and removed once the files are in place
+    STAGING_ROOT = "/tmp"
+
+    def __init__(self):
+        self.files = []
 
 
-def substitute(file_path, substitutions, substituted_file_path):
-    with open(file_path, "r") as source:
-        content = source.read()
-    for substitution in substitutions:
-        pattern = substitution['pattern']
-        replacement = substitution['replacement']
-        content = string.replace(content, pattern, replacement)
-    with open(substituted_file_path, "w") as sink:
-        sink.write(content)
-    return substituted_file_path
+    def add(self, path, content, mode, user="root", group="root", secret=False):
+        # The content of a secret file is left out of plans
+        self.files.append({'path': path, 'content': content, 'digest': digest(content), 'mode': mode, 'user': user, 'group': group, 'secret': secret})
+
+
+    def paths(self):
+        return [file['path'] for file in self.files]
+
+
+    def changed_paths(self, digests):
+        # The paths of the files whose content doesn't match the given digests (keyed by path)
+        return set(file['path'] for file in self.files if digests.get(file['path']) != file['digest'])
+
+
+    def keep_changed(self, digests):
+
+        # Drop the files whose content matches the given digests, and return the paths of the rest
+        changed_paths = self.changed_paths(digests)
+        self.files = [file for file in self.files if file['path'] in changed_paths]
+        return changed_paths
+
+
+    def archive(self):
+
+        # Build a compressed tar archive in memory, with paths relative to the root directory
+        buffer = io.BytesIO()
+        archive = tarfile.open(fileobj=buffer, mode="w:gz")
+        now = time.time()
+        for file in self.files:
+            info = tarfile.TarInfo(file['path'].lstrip("/"))
+            info.size = len(file['content'])
+            info.mode = file['mode']
+            info.uname = file['user']
+            info.gname = file['group']
+            info.mtime = now
+            archive.addfile(info, io.BytesIO(file['content']))
+        archive.close()
+        return buffer.getvalue()
+
+
+    def fingerprint(self):
+        # Identifies exactly which files (and which content of each) are in the payload
+        return digest(" ".join(file['path'] + "=" + file['digest'] for file in self.files))
+
+
+    def add_install_steps(self, script):
+        add_unpack_steps(script, self.paths())
+
+
+# A runtime drop-in (gone after a reboot) for a service, which keeps its other processes running when it's restarted
+KEEP_EXECUTORS_DROP_IN = "/run/systemd/system/{0}.d/wim-keep-executors.conf"
+
+
+def add_keep_executors_steps(script, service_name):
+
+    # Only the Mesos slave itself is stopped by a restart, leaving its executors (and their tasks) to be recovered
+    drop_in = KEEP_EXECUTORS_DROP_IN.format(service_name)
+    script.add(
+        "sudo mkdir -p " + os.path.dirname(drop_in) + " && printf '[Service]\\nKillMode=process\\n' | sudo tee " + drop_in + " > /dev/null",
+        description="Keep the executors of " + service_name + " running while it restarts"
+    )
+    script.add_cleanup("sudo rm -f " + drop_in + "; sudo systemctl daemon-reload")
+
+
+def add_unpack_steps(script, paths, archive_root="/"):
+
+    # Unpack an archive of the given files (read from the script's input, with paths relative to the archive root) into
+    # a private staging directory, as root so that modes and ownership are kept. The directory is made by mktemp on the
+    # slave, so no one else can have made it first, and it is only named by a variable, so that the same plan always
+    # renders the same script.
+    script.add_setup("staging=$(sudo mktemp -d " + Payload.STAGING_ROOT + "/wim-payload-XXXXXX)")
+    script.add_cleanup("sudo rm -rf $staging")
+    script.add("sudo tar -xzpf - -C $staging")
+
+    # Move each file into place with a rename, so nothing ever sees a partly written file
+    directories = sorted(set(os.path.dirname(path) for path in paths))
+    script.add("sudo install -d " + " ".join(directories))
+    for path in paths:
+        staged_path = "$staging/" + path[len(archive_root):].lstrip("/")
+        script.add("sudo cp -p {0} {1}.wim-new && sudo mv -f {1}.wim-new {1}".format(staged_path, path))
+
+
+# Transports -----------------------------------------------
+#
+# A transport runs commands on slave nodes. execute() feeds the command any given input, and returns its exit
+# code: UNREACHABLE_EXIT_CODE if the slave couldn't be reached, or TIMEOUT_EXIT_CODE if the command was killed for
+# taking longer than any given timeout. Each line of output is passed to the given output function (or else the log
+# for the host), unless a 'stdout' file is given, in which case only error output is passed on. relay_command()
+# returns a command which, when run on one slave, runs the given command on another.
+
+# The exit code of ssh when it can't reach a host, and of the timeout command when it kills one
+UNREACHABLE_EXIT_CODE = 255
+TIMEOUT_EXIT_CODE = 124
+
+class SshTransport:
+
+    def __init__(self, username, control_persist, connect_timeout=10, forward_agent=False):
+        self.username = username
+        self.control_persist = control_persist
+        self.connect_timeout = connect_timeout
+        self.forward_agent = forward_agent
+
+        # Keep the control sockets in a private directory with a short path (sockets have a small path limit)
+        self.control_dir = tempfile.mkdtemp(prefix="wim-ssh-")
+        self.hosts = set()
+        self.hosts_lock = threading.Lock()
+
+
+    def options(self, host):
+
+        with self.hosts_lock:
+            self.hosts.add(host)
+
+        # The first command to a host opens a master connection, which later commands then share
+        options = [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=" + self.control_dir + "/%C",
+            "-o", "ControlPersist=" + self.control_persist,
+            "-o", "ConnectTimeout=" + str(self.connect_timeout)
+        ]
+        if self.forward_agent:
+            options.append("-A")
+        return options
+
+
+    def execute(self, host, command, input=None, output=None, stdout=None, timeout=None):
+        return call_logged(host, ["ssh"] + self.options(host) + [self.username + "@" + host, command], input=input, output=output, stdout=stdout, timeout=timeout)
+
+
+    def relay_command(self, host, command):
+        # Slaves can't answer questions, so this fails rather than prompt (eg. for an unknown host key)
+        return "ssh -o BatchMode=yes " + self.username + "@" + host + " " + pipes.quote(command)
+
+
+    def close(self):
+
+        # Shut down the master connections, rather than leave them lingering until ControlPersist runs out
+        for host in self.hosts:
+            call_logged(host, ["ssh"] + self.options(host) + ["-O", "exit", self.username + "@" + host])
+        shutil.rmtree(self.control_dir, True)
+
+
+# Stand-ins for the privileged commands the installer runs on slaves, installed on the PATH of the local transport
+LOCAL_TRANSPORT_SHIMS = {
+    "sudo": """#!/bin/sh
+exec "$@"
+""",
+    "chown": """#!/bin/sh
+exit 0
+""",
+    "hostname": """#!/bin/sh
+basename "$WIM_HOST_ROOT"
+""",
+    "systemctl": """#!/bin/sh
+units="$WIM_HOST_ROOT/run/wim-units"
+mkdir -p "$units" "$WIM_HOST_ROOT/var/log"
+echo "systemctl $*" >> "$WIM_HOST_ROOT/var/log/systemctl.log"
+command="$1"
+shift
+status=0
+for unit in "$@"; do
+    case "$unit" in -*) continue ;; esac
+    case "$command" in
+        start|restart|reload-or-restart|try-restart) echo active > "$units/$unit" ;;
+        stop) echo inactive > "$units/$unit" ;;
+        is-active)
+            # Docker runs on every simulated slave, unless stopped
+            state=$(cat "$units/$unit" 2>/dev/null)
+            if [ -z "$state" ] && [ "$unit" = docker.service ]; then state=active; fi
+            if [ "$state" = active ]; then echo active; else echo inactive; status=3; fi ;;
+    esac
+done
+exit $status
+""",
+    "wim-relay": """#!python
+import binascii, os, subprocess, sys
+host_root = os.path.join(os.path.dirname(os.environ["WIM_HOST_ROOT"]), sys.argv[1])
+environment = dict(os.environ)
+environment["WIM_HOST_ROOT"] = host_root
+sys.exit(subprocess.call(["sh", "-c", binascii.unhexlify(sys.argv[2])], cwd=host_root, env=environment))
+"""
+}
+
+
+class LocalTransport:
+
+    # An absolute path at the start of a word, other than a device
+    ABSOLUTE_PATH_PATTERN = re.compile(r'(?:(?<=^)|(?<=[\s\'"=;|&(]))/(?!dev/)(?=[^\s/])')
+
+    # Exit code for a simulated failure
+    FAILURE_EXIT_CODE = UNREACHABLE_EXIT_CODE
+
+    def __init__(self, root, latency=0.0, failure_rate=0.0, random_seed=None):
+        self.root = os.path.abspath(root)
+
+        # Faults to inject, so that a run behaves more like one over a real network
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(random_seed)
+        self.random_lock = threading.Lock()
+
+        # Install the command shims
+        self.shim_dir = self.root + "/.shims"
+        if not os.path.isdir(self.shim_dir):
+            os.makedirs(self.shim_dir)
+        for name, content in LOCAL_TRANSPORT_SHIMS.items():
+            path = self.shim_dir + "/" + name
+            with open(path, "w") as sink:
+                sink.write(content.replace("#!python", "#!" + sys.executable, 1))
+            os.chmod(path, 0755)
+
+
+    def host_root(self, host):
+        # Like any real slave, a simulated one has a /tmp
+        host_root = self.root + "/" + host
+        if not os.path.isdir(host_root + "/tmp"):
+            os.makedirs(host_root + "/tmp")
+        return host_root
+
+
+    def map_paths(self, host, command):
+        return LocalTransport.ABSOLUTE_PATH_PATTERN.sub(self.host_root(host) + "/", command)
+
+
+    def relay_command(self, host, command):
+        # The command is hex encoded, so that its paths are left alone by the mapping for the slave that runs it
+        return "wim-relay " + host + " " + binascii.hexlify(self.map_paths(host, command))
+
+
+    def execute(self, host, command, input=None, output=None, stdout=None, timeout=None):
+
+        # Take as long as a round trip to the slave would, and fail as often as we were told to
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.failure_rate > 0:
+            with self.random_lock:
+                failed = self.random.random() < self.failure_rate
+            if failed:
+                log(host, "Simulated failure of the connection to the slave")
+                return LocalTransport.FAILURE_EXIT_CODE
+
+        # Run the command locally, with absolute paths moved under the directory for the host
+        host_root = self.host_root(host)
+        command = self.map_paths(host, command)
+        environment = dict(os.environ)
+        environment["PATH"] = self.shim_dir + os.pathsep + environment.get("PATH", "")
+        environment["WIM_HOST_ROOT"] = host_root
+
+        # Show paths in the output as the slave would see them
+        if output is None:
+            output = lambda line: log(host, line)
+        unmapped_output = lambda line: output(line.replace(host_root + "/", "/"))
+
+        # The commands the shell starts hold its output open, so a timeout kills them too (nothing here prompts)
+        return call_logged(host, ["sh", "-c", command], input=input, output=unmapped_output, stdout=stdout, timeout=timeout, kill_group=True, cwd=host_root, env=environment)
+
+
+    def close(self):
+        pass
+
+
+# Local files are read, and content hashed, once per run, however many slaves they go to
+local_files = {}
+digests = {}
+
+
+def read_file(file_path):
+    if not file_path in local_files:
+        with open(file_path, "rb") as source:
+            local_files[file_path] = source.read()
+    return local_files[file_path]
+
+
+def digest(content):
+    if not content in digests:
+        digests[content] = hashlib.sha256(content).hexdigest()
+    return digests[content]
+
+
+def render_file(file_path, substitutions=None):
+    if substitutions is None:
+        return read_file(file_path)
+    return load_template(file_path).render(substitutions)
+
+
+# Templates are compiled once per run, and each distinct rendering of them kept
+templates = {}
+
+
+def load_template(file_path):
+    if not file_path in templates:
+        templates[file_path] = Template(file_path, read_file(file_path))
+    return templates[file_path]
+
+
+class Template:
+
+    PLACEHOLDER_PATTERN = re.compile(r"(\{\{[A-Za-z0-9_]+\}\})")
+
+    def __init__(self, name, content):
+        # Split the content into literal text (at even indices) and placeholders (at odd ones)
+        self.name = name
+        self.parts = Template.PLACEHOLDER_PATTERN.split(content)
+        self.placeholders = set(self.parts[1::2])
+        self.renders = {}
+
+
+    def render(self, substitutions):
+
+        # Same values, same output
+        replacements = dict((substitution['pattern'], substitution['replacement']) for substitution in substitutions)
+        key = tuple(sorted(replacements.items()))
+        if key in self.renders:
+            return self.renders[key]
+
+        # Every placeholder needs a value, and every value a placeholder, or something would silently be left out
+        missing = self.placeholders - set(replacements)
+        if missing:
+            raise ValueError("No value given for placeholders in " + self.name + ": " + ", ".join(sorted(missing)))
+        unknown = set(replacements) - self.placeholders
+        if unknown:
+            raise ValueError("Values given for placeholders not in " + self.name + ": " + ", ".join(sorted(unknown)))
+
+        # Fill in all the placeholders in one pass
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            parts[index] = replacements[parts[index]]
+        content = "".join(parts)
+        self.renders[key] = content
+        return content
+
+
+# Caches are kept in the local temporary directory, which other users may share (as they do /tmp), so a cache is only
+# trusted if it is a file of our own that nobody else can write to, and is only ever replaced whole, by a new file
+def load_private_json(file_path, default):
+    try:
+        descriptor = os.open(file_path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return default
+    with os.fdopen(descriptor, "r") as source:
+        status = os.fstat(descriptor)
+        if not stat.S_ISREG(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0022:
+            return default
+        try:
+            return json.load(source)
+        except ValueError:
+            return default
+
+
+def save_private_json(file_path, value):
+    descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", dir=os.path.dirname(file_path) or ".")
+    try:
+        with os.fdopen(descriptor, "w") as sink:
+            json.dump(value, sink)
+        os.rename(temporary_path, file_path)
+    except (IOError, OSError) as e:
+        # Most likely someone else's file is in the way, which leaves nothing to remember things in
+        os.remove(temporary_path)
+        print "Could not save " + file_path + ": " + str(e)
+
+
+def discover_slaves(url, cache_file_path, ttl):
+
+    # Use the slaves found last time, if that was recent enough
+    cache = load_private_json(cache_file_path, {})
+    entry = cache.get(url)
+    if entry is not None:
+        age = time.time() - entry['time']
+        if 0 <= age < ttl:
+            announce("Using the Mesos slaves found at " + url + " {0:.0f} seconds ago: {1} public, {2} private".format(
+                age, len(entry['public']), len(entry['private'])
+            ))
+            return entry['public'], entry['private']
+
+    # Otherwise ask the Mesos master
+    try:
+        response = urllib2.urlopen(url, timeout=30)
+        try:
+            state = json.load(response)
+        finally:
+            response.close()
+    except (urllib2.URLError, IOError, ValueError) as e:
+        raise Exception("Could not get the Mesos slaves from " + url + ": " + str(e))
+    public_slaves, private_slaves = parse_mesos_slaves(state)
+    announce("Found Mesos slaves at {0}: {1} public, {2} private".format(url, len(public_slaves), len(private_slaves)))
+
+    # And remember what it said
+    cache[url] = {'time': time.time(), 'public': public_slaves, 'private': private_slaves}
+    save_private_json(cache_file_path, cache)
+    return public_slaves, private_slaves
+
+
+def mesos_master_request(url, data=None):
+
+    # GET from the Mesos master, or POST the given data, as JSON either way
+    request = urllib2.Request(url)
+    if data is not None:
+        request.add_header("Content-Type", "application/json")
+        request.add_data(json.dumps(data))
+    try:
+        response = urllib2.urlopen(request, timeout=30)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        return json.loads(content) if content.strip() != "" else None
+    except (urllib2.URLError, IOError, ValueError) as e:
+        raise Exception("Mesos master request failed: " + url + ": " + str(e))
+
+
+def find_mesos_agent(state, names):
+
+    # The slave (in the master's /slaves) with any of the given hostnames or addresses
+    for agent in state.get('slaves', []):
+        if agent.get('hostname') in names or mesos_machine_id(agent)['ip'] in names:
+            return agent
+    return None
+
+
+def mesos_machine_id(agent):
+    # A machine is known to the maintenance API by its hostname and IP address, which is in the slave's PID
+    return {'hostname': agent['hostname'], 'ip': agent.get('pid', "").rpartition("@")[2].partition(":")[0]}
+
+
+# Tasks in these states are still on their slave
+ACTIVE_TASK_STATES = ["TASK_STAGING", "TASK_STARTING", "TASK_RUNNING", "TASK_KILLING"]
+
+
+def running_tasks(state, agent_id):
+    return [task for task in state.get('tasks', []) if task.get('slave_id') == agent_id and task.get('state') in ACTIVE_TASK_STATES]
+
+
+def parse_mesos_slaves(state):
+
+    # Every active slave, by hostname. DC/OS public agents have resources reserved for the 'slave_public' role, and
+    # are usually given a 'public_ip' attribute too.
+    public_slaves = []
+    private_slaves = []
+    for slave in state.get('slaves', []):
+        if not slave.get('active', True):
+            continue
+        is_public = 'slave_public' in slave.get('reserved_resources', {}) or is_truthy(str(slave.get('attributes', {}).get('public_ip', "false")))
+        if is_public:
+            public_slaves.append(slave['hostname'])
+        else:
+            private_slaves.append(slave['hostname'])
+    return sorted(public_slaves), sorted(private_slaves)
+
+
+# The environment file each Weave service reads for the slave it runs on, named after its hostname (%H, to systemd)
+WEAVE_HOST_ENV_FILE = "/etc/weave.%H.env"
+
+# The variable in it that the router's initial peer count is given in
+INIT_PEER_COUNT_VARIABLE = "WEAVE_ROUTER_INIT_PEER_COUNT"
+
+
+# The Mesos slave services each flavor of Mesos runs (newer vanilla Mesos calls its slaves agents), and where systemd
+# unit files are found
+MESOS_SLAVE_SERVICES = ["dcos-mesos-slave-public.service", "dcos-mesos-slave.service", "mesos-slave.service", "mesos-agent.service"]
+MESOS_SLAVE_UNIT_DIRS = ["/etc/systemd/system", "/lib/systemd/system", "/usr/lib/systemd/system"]
+
+
+# What 'weave status' says of an IP address manager that has what it needs to allocate addresses ('idle' being one that
+# hasn't needed to yet)
+WEAVE_IPAM_READY_STATUSES = ["ready", "idle"]
+
+
+def parse_weave_status(lines):
+
+    # The numbers that matter from the 'Name: value' lines of 'weave status' (only the router's section has
+    # connections and peers, and only the IPAM section has a status)
+    status = {}
+    for line in lines:
+        name, _, value = line.strip().partition(":")
+        value = value.strip()
+        numbers = [int(number) for number in re.findall(r'\d+', value)]
+        if name == "Peers" and len(numbers) != 0:
+            status['peers'] = numbers[0]
+        elif name == "Connections" and len(numbers) != 0:
+            status['connections'] = numbers[0]
+            match = re.search(r'(\d+) established', value)
+            status['established'] = int(match.group(1)) if match else 0
+        elif name == "Targets" and len(numbers) != 0:
+            status['targets'] = numbers[0]
+        elif name == "Status":
+            status['ipam_status'] = value
+    return status
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize_mesh(metrics):
+
+    # Distributions of how long the routers took, and how connected they are
+    def stats(values):
+        if len(values) == 0:
+            return None
+        return {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9), 'min': min(values), 'max': max(values)}
+    to_mesh = [record['seconds_to_mesh'] for record in metrics if record.get('seconds_to_mesh') is not None]
+    to_ipam = [record['seconds_to_ipam'] for record in metrics if record.get('seconds_to_ipam') is not None]
+    connections = [record['established'] for record in metrics if 'established' in record]
+    summary = {
+        'slaves': len(metrics),
+        'converged': len([record for record in metrics if record['converged']]),
+        'seconds_to_mesh': stats(to_mesh),
+        'seconds_to_ipam': stats(to_ipam),
+        'connections': stats(connections),
+        'outliers': []
+    }
+
+    # A router stands out if it never converged, took far longer than the typical one (by the median absolute
+    # deviation, but at least a couple of checks' worth), or has far fewer connections
+    if len(to_mesh) != 0:
+        median = percentile(to_mesh, 0.5)
+        slow = median + max(3 * percentile([abs(value - median) for value in to_mesh], 0.5), 2 * Installer.MESH_CHECK_INTERVAL)
+    for record in metrics:
+        reasons = []
+        if not record['converged']:
+            reasons.append(record.get('error') or "did not converge")
+        if record.get('seconds_to_mesh') is not None and record['seconds_to_mesh'] > slow:
+            reasons.append("saw the whole mesh after {0:.1f}s (median {1:.1f}s)".format(record['seconds_to_mesh'], median))
+        if 'established' in record and len(connections) != 0 and record['established'] * 2 < summary['connections']['p50']:
+            reasons.append("{0} connections (median {1})".format(record['established'], summary['connections']['p50']))
+        if len(reasons) != 0:
+            summary['outliers'].append({'host': record['host'], 'reasons': reasons})
+    return summary
+
+
+def detect_mesos_flavor(services, is_public):
+
+    # The flavor of Mesos, and the Mesos slave service, of a slave with the given services. A DC/OS slave can have the
+    # units of both roles, so the one for the slave's own role comes first.
+    preferred = list(MESOS_SLAVE_SERVICES)
+    if not is_public:
+        preferred[0], preferred[1] = preferred[1], preferred[0]
+    for service in preferred:
+        if service in services:
+            flavor = Installer.FLAVOR_DCOS if service.startswith("dcos-") else Installer.FLAVOR_VANILLA
+            return flavor, service
+    return None, None
+
+
+def parse_digests(lines):
+    # Lines of sha256sum output, as a map of path to digest
+    digests = {}
+    for line in lines:
+        fields = line.split(None, 1)
+        if len(fields) == 2:
+            digests[fields[1]] = fields[0]
+    return digests
+
+
+def plan_peers(slaves, seed_count, ring_count):
+
+    # Small clusters are a full mesh: every router is given every slave
+    if len(slaves) <= seed_count + ring_count + 1:
+        return dict((slave, list(slaves)) for slave in slaves)
+
+    # Otherwise every router is given the same few seed slaves, which keeps the routers connected however the others
+    # fail, plus the slaves after it on a ring, to spread the connections around. Both are chosen by hash, so that
+    # adding or removing a slave changes the peers of as few others as possible.
+    seeds = sorted(slaves, key=lambda slave: digest("seed " + slave))[:seed_count]
+    ring = sorted(slaves, key=lambda slave: digest("ring " + slave))
+    peers = {}
+    for index, slave in enumerate(ring):
+        chosen = [seed for seed in seeds if seed != slave]
+        successor = index
+        while len(chosen) < seed_count + ring_count - (1 if slave in seeds else 0):
+            successor = (successor + 1) % len(ring)
+            if ring[successor] != slave and not ring[successor] in chosen:
+                chosen.append(ring[successor])
+        peers[slave] = chosen
+    return peers
+
+
+def plan_scope_apps(slaves, named, count):
+
+    # The slaves to run the Scope app on: those named, or else a few chosen by hash, so that the same ones keep being
+    # chosen as slaves come and go
+    if len(named) != 0:
+        return [slave for slave in slaves if slave in named]
+    return sorted(slaves, key=lambda slave: digest("scope " + slave))[:count]
+
+
+def plan_init_peer_count(slaves, peers, given):
+    # The initial peer count for the Weave routers' IP address allocation: as given, or else, once a router can't be
+    # given every slave as a peer, the number of slaves
+    if given is None and any(len(slave_peers) != len(slaves) for slave_peers in peers.values()):
+        return str(len(slaves))
+    return given
+
+
+def router_environment(peers, password=None, init_peer_count=None):
+
+    # The content of a slave's environment file, for its Weave router (Weave reads the password from its environment)
+    environment = "WEAVE_ROUTER_PEERS=\"" + " ".join(peers) + "\"\n"
+    if init_peer_count is not None:
+        environment += INIT_PEER_COUNT_VARIABLE + "=" + init_peer_count + "\n"
+    if password is not None:
+        environment += "WEAVE_PASSWORD=\"" + password.replace("\\", "\\\\").replace("\"", "\\\"") + "\"\n"
+    return environment
+
+
+def without_init_peer_count(environment):
+    # A router's environment, less its initial peer count, which only matters to a router being started for the first
+    # time, so isn't worth restarting a running one for
+    return "".join(line for line in environment.splitlines(True) if not line.startswith(INIT_PEER_COUNT_VARIABLE + "="))
 
 
 def parse_delimited_list(string):
@@ -757,6 +3496,21 @@ def parse_delimited_list(string):
     return list
 
 
+def strip_option(arguments, option):
+
+    # The given command line arguments, without the given option and its value
+    stripped = []
+    skip = False
+    for argument in arguments:
+        if skip:
+            skip = False
+        elif argument == option:
+            skip = True
+        elif not argument.startswith(option + "="):
+            stripped.append(argument)
+    return stripped
+
+
 def is_truthy(string):
     return string.lower() in ['true', 'yes', '1', 't', 'y']
 